@@ -0,0 +1,135 @@
+import time
+import random
+import logging
+import threading
+
+from collections import deque
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult:
+    def __init__(self):
+        self.succeeded = defaultdict(list)
+        self.failed = defaultdict(list)
+        self.planned = defaultdict(list)
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def add(self, operation, key, error=None):
+        with self._lock:
+            if error is None:
+                self.succeeded[operation].append(key)
+            else:
+                self.failed[operation].append((key, str(error)))
+
+    def add_planned(self, operation, key):
+        with self._lock:
+            self.planned[operation].append(key)
+
+    def add_throttle(self):
+        with self._lock:
+            self.throttled += 1
+
+    def summary(self):
+        operations = sorted(set(self.succeeded) | set(self.failed))
+        if self.planned:
+            return {'planned': dict(self.planned)}
+        return {
+            'operations': {
+                operation: {'succeeded': len(self.succeeded[operation]),
+                            'failed': len(self.failed[operation])}
+                for operation in operations
+            },
+            'failures': {operation: self.failed[operation] for operation in operations if self.failed[operation]},
+            'throttled': self.throttled,
+        }
+
+
+class BatchExecutor:
+    """Runs mutating EC2 calls on a bounded thread pool.
+
+    Every operation name gets its own concurrency limit, throttling errors are
+    retried with jittered exponential backoff and every outcome is collected
+    into a BatchResult. With dry_run set, calls are only recorded as planned.
+    """
+
+    def __init__(self, max_workers, limits=None, max_attempts=6, base_delay=0.5, max_delay=10, dry_run=False):
+        self.dry_run = dry_run
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.result = BatchResult()
+        self._limits = dict(limits or {})
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        # Calls over their operation's limit wait here instead of blocking a pool worker
+        self._queued = defaultdict(deque)
+        self._running = defaultdict(int)
+        self._outstanding = 0
+        self._errors = []
+        self._done = threading.Condition()
+
+    def submit(self, operation, key, func, **kwargs):
+        if self.dry_run:
+            self.result.add_planned(operation, key)
+            return
+        with self._done:
+            self._outstanding += 1
+            self._queued[operation].append((key, func, kwargs))
+            self._start(operation)
+
+    def _start(self, operation):
+        # Callers hold self._done
+        limit = self._limits.get(operation)
+        queued = self._queued[operation]
+        while queued and (limit is None or self._running[operation] < limit):
+            self._running[operation] += 1
+            self._pool.submit(self._task, operation, *queued.popleft())
+
+    def wait(self):
+        # Unexpected errors are raised once every call has finished
+        try:
+            with self._done:
+                while self._outstanding:
+                    self._done.wait()
+        finally:
+            self._pool.shutdown()
+        if self._errors:
+            raise self._errors[0]
+        return self.result
+
+    def _task(self, operation, key, func, kwargs):
+        try:
+            self._run(operation, key, func, kwargs)
+        except Exception as e:
+            logger.exception("{} {} failed".format(operation, key))
+            self.result.add(operation, key, e)
+            self._errors.append(e)
+        finally:
+            with self._done:
+                self._running[operation] -= 1
+                self._outstanding -= 1
+                self._start(operation)
+                self._done.notify_all()
+
+    def _run(self, operation, key, func, kwargs):
+        for attempt in range(self.max_attempts):
+            try:
+                func(**kwargs)
+                logger.info("{} {} succeeded".format(operation, key))
+                self.result.add(operation, key)
+                return
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt == self.max_attempts - 1:
+                    logger.warning("{} {} failed: {}".format(operation, key, e))
+                    self.result.add(operation, key, e)
+                    return
+                self.result.add_throttle()
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay))
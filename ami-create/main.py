@@ -1,15 +1,21 @@
 import os
-import re
 import json
 import time
 import logging
 
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-
-from botocore.exceptions import ClientError
+from accounts import FAN_OUT_WORKERS
+from accounts import list_accounts
+from batch import BatchExecutor
+from clients import get_client
+from retention import group_images
+from retention import plan_retention
+from state import ImageState
+from state import open_state_store
 
 DATE_FORMAT = "%Y-%m-%dT%H.%M.%S"
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
@@ -17,31 +23,118 @@ INSTANCE_NAME_PREFIX = os.environ.get('INSTANCE_PREFIXES', 'Crawler,Mongo').spli
 COPIES_TO_KEEP = int(os.environ.get('AMI_RETENTION_COUNT', '10'))
 SNS_TOPIC = os.environ.get('SNS_TOPIC_ARN', 'arn:aws:sns:eu-central-1:214673208397:ops-reports')
 INTERVAL = os.environ.get('AMI_INTERVAL', 'daily')
+AMI_REGIONS = [region.strip() for region in os.environ.get('AMI_REGIONS', '').split(',') if region.strip()]
+RETENTION_MODE = os.environ.get('AMI_RETENTION_MODE', 'count')
+GFS_DAILY = int(os.environ.get('AMI_GFS_DAILY', '7'))
+GFS_WEEKLY = int(os.environ.get('AMI_GFS_WEEKLY', '4'))
+GFS_MONTHLY = int(os.environ.get('AMI_GFS_MONTHLY', '12'))
+DRY_RUN = os.environ.get('AMI_DRY_RUN', 'false').lower() == 'true'
+STATE_URI = os.environ.get('AMI_STATE_URI', '')
+RECONCILE_HOURS = int(os.environ.get('AMI_RECONCILE_HOURS', '168'))
+INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+DO_NOT_DELETE_TAG = 'DO NOT DELETE'
+SNAPSHOT_DESCRIPTION_PATTERN = 'Created by CreateImage*'
+SNAPSHOT_STATES = ['completed']
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '500'))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '16'))
+BATCH_LIMITS = {
+    'create_image': int(os.environ.get('CREATE_IMAGE_CONCURRENCY', '4')),
+    'deregister_image': int(os.environ.get('DEREGISTER_IMAGE_CONCURRENCY', '8')),
+    'delete_snapshot': int(os.environ.get('DELETE_SNAPSHOT_CONCURRENCY', '8')),
+}
 
 
 logger = logging.getLogger()
 logger.setLevel(LOGLEVEL.upper())
 
 
-def update_sns(instance_name, duration):
-    sns_client = boto3.client('sns', region_name='eu-west-1')
-    subject = 'AMI missing'.format(instance_name)
+def update_sns(alerts):
+    # The topic region is taken from its ARN so a single alert covers every rotated region
+    sns_client = get_client('sns', SNS_TOPIC.split(':')[3])
+    message = "\n".join(
+        'No AMI have been create for {} ({}) in {}{}, Last AMI created {:.1f} hours ago'.format(
+            alert['instance'], alert['name'], alert['region'],
+            ' of account {}'.format(alert['account']) if alert.get('account') else '', alert['hours'])
+        for alert in alerts)
     response = sns_client.publish(
         TopicArn=SNS_TOPIC,
-        Message=subject,
-        Subject='No AMI have been create for {}, Last AMI created {} hours ago'.format(instance_name, duration),
+        Message=message,
+        Subject='AMI missing for {} instance(s)'.format(len(alerts)),
     )
-    
-def lambda_handler(event, context):
-    instance_dictionary = {}
+
+
+def state_uri_for(region, account_id=None):
+    # AMI_STATE_URI may contain {region} and {account} placeholders, otherwise each
+    # region and account gets its own suffixed state object when several are rotated
+    if not STATE_URI:
+        return STATE_URI
+    uri = STATE_URI
+    if '{region}' in uri or '{account}' in uri:
+        uri = uri.format(region=region or 'default', account=account_id or 'default')
+    if len(AMI_REGIONS) > 1 and '{region}' not in STATE_URI:
+        uri = '{}.{}'.format(uri, region)
+    if account_id and '{account}' not in STATE_URI:
+        uri = '{}.{}'.format(uri, account_id)
+    return uri
+
+
+def paginate(client, operation, key, **kwargs):
+    # Pages are only requested from the API as the caller consumes items
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(PaginationConfig={'PageSize': PAGE_SIZE}, **kwargs):
+        for item in page.get(key, []):
+            yield item
+
+
+def iter_instances(client, instance_names):
+    reservations = paginate(client, 'describe_instances', 'Reservations',
+                            Filters=[{'Name': 'tag:Name', 'Values': instance_names},
+                                     {'Name': 'instance-state-name', 'Values': INSTANCE_STATES}])
+    for reservation in reservations:
+        for instance in reservation['Instances']:
+            yield instance
+
+
+def iter_images(client, creation_dates=None):
+    # Every owned image is listed, not only the Lambda ones, so snapshots backing
+    # any registered AMI are never treated as orphans
+    filters = [{'Name': 'creation-date', 'Values': creation_dates}] if creation_dates else []
+    return paginate(client, 'describe_images', 'Images', Owners=['self'], Filters=filters)
+
+
+def iter_snapshots(client):
+    return paginate(client, 'describe_snapshots', 'Snapshots',
+                    OwnerIds=['self'],
+                    Filters=[{'Name': 'description', 'Values': [SNAPSHOT_DESCRIPTION_PATTERN]},
+                             {'Name': 'status', 'Values': SNAPSHOT_STATES}])
+
+
+def index_snapshot_owners(images, snapshot_owners):
+    # snapshot id -> AMI id, taken from the image block device mappings
+    for image in images:
+        for mapping in image.get('BlockDeviceMappings', []):
+            snapshot_id = mapping.get('Ebs', {}).get('SnapshotId')
+            if snapshot_id:
+                snapshot_owners[snapshot_id] = image['ImageId']
+        yield image
+
+
+def get_tag(item, key):
+    for tag in item.get('Tags', []):
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def rotate_region(region, account_id=None):
     instance_names = {}
-    client = boto3.client('ec2')
-    resource = boto3.resource('ec2')
+    alerts = []
+    # One connection per batch worker plus the listing thread, botocore keeps 10 by default
+    client = get_client('ec2', region, account_id, max_pool_connections=BATCH_WORKERS + 1)
+    executor = BatchExecutor(BATCH_WORKERS, BATCH_LIMITS, dry_run=DRY_RUN)
     
-    ami_keep_list = []
-    instances = client.describe_instances()
-    images = resource.images.filter(Owners=['self'])
-    snapshots_dict = client.describe_snapshots(OwnerIds=["self"])
+    snapshot_owners = {}
+    run_started = datetime.now(timezone.utc)
     
     if INTERVAL == "daily":
         hours_between_amis = 24
@@ -50,128 +143,124 @@ def lambda_handler(event, context):
     else:
         hours_between_amis = 0
     
-    # Get instance for the account
-    logger.info("Reviewing {} instances".format(len(instances["Reservations"])))
-    for reservation in instances["Reservations"]:
-        for instance in reservation["Instances"]:
-            try:
-                for tag in instance["Tags"]:
-                    if tag["Key"] == "Name" and tag["Value"] in INSTANCE_NAME_PREFIX:
-                        logger.info("adding {} to instances dictionary".format(instance["InstanceId"]))
-                        instance_names[instance["InstanceId"]] = tag["Value"]
-                        instance_id = instance["InstanceId"]
-                        instance_dictionary[instance_id] = []
-            except:
-                logger.warning("No Name tag found")
-                pass
+    # Get instance for the account, the Name/state filtering is done by the EC2 API
+    for instance in iter_instances(client, INSTANCE_NAME_PREFIX):
+        logger.info("adding {} to instances dictionary".format(instance["InstanceId"]))
+        instance_names[instance["InstanceId"]] = get_tag(instance, "Name")
+    logger.info("Reviewing {} instances".format(len(instance_names)))
     
-    # Get AMIs for instanses requested
-    for image in images:
-        try:
-            if image.name.split(" ")[2] in instance_dictionary.keys():
-                instance_name = image.name.split(" ")[2]
-                image_date = datetime.strptime(image.creation_date[:-5].replace(":","."), DATE_FORMAT).strftime(DATE_FORMAT)
-                instance_dictionary[instance_name].append("{} {}".format(image_date, image.image_id))
-                ami_keep_list.append(image.image_id)
-        except Exception as e:
-            logger.warning(e)
-    
-    # Sort Images by date and reverse to 
-    for key, value in instance_dictionary.items():
-        value.sort(reverse=True)
+    # Only images created since the last run are listed when a state store is set,
+    # the full listing runs on the first run and every RECONCILE_HOURS
+    store = open_state_store(state_uri_for(region, account_id))
+    state = store.load() if store else None
+    full_listing = state is None or state.needs_reconcile(run_started.timestamp(), RECONCILE_HOURS)
+    if full_listing:
+        state = state or ImageState()
+        images = iter_images(client)
+    else:
+        images = iter_images(client, state.creation_date_patterns(run_started.timestamp()))
+    logger.info("Listing {} images".format("all" if full_listing else "new"))
+    images = state.sync(images, run_started.timestamp(), full_listing)
+
+    # Get AMIs for instanses requested, newest first, and index the snapshots each AMI owns
+    images_by_instance = group_images(index_snapshot_owners(images, snapshot_owners), instance_names)
         
     # Create an AMI if the time has come
-    for instance, snapshots in instance_dictionary.items():
+    for instance in instance_names:
         now = datetime.now().strftime(DATE_FORMAT)
-        try:
-            newest_ami_date = snapshots[0].split(" ")[0]
+        records = images_by_instance.get(instance)
+        if records:
+            newest_ami_date = datetime.fromtimestamp(records[0].created, timezone.utc)
             logger.info("Latest AMI for {} was created at {}".format(instance_names[instance], newest_ami_date))
-        except IndexError:
-            newest_ami_date = (datetime.now() - timedelta(days=365)).strftime(DATE_FORMAT)
+        else:
+            newest_ami_date = run_started - timedelta(days=365)
             
-        difference = datetime.now().strptime(now, DATE_FORMAT) - datetime.strptime(newest_ami_date, DATE_FORMAT)
+        difference = datetime.now(timezone.utc) - newest_ami_date
 
         logger.info(difference.total_seconds() / 3600)
 
         if difference.total_seconds() / 3600 >= hours_between_amis:
-            try:
-                logger.info("taking snapshot for {}".format(instance))
-                creating = "true"
-                client.create_image(InstanceId=instance, 
-                                    Name="Lambda - {} from {}".format(instance, now), 
-                                    Description="Lambda created AMI of instance {} from {}".format(instance, now), 
-                                    TagSpecifications=[{'ResourceType': 'image', 'Tags': [{'Key': 'Name', 'Value': instance_names[instance]}]}],
-                                    NoReboot=True, 
-                                    DryRun=False)
-            except ClientError as e:
-                logger.warning(e)
-                creating = "true"
-                logger.info("AMI already being created")
+            logger.info("taking snapshot for {}".format(instance))
+            creating = "true"
+            executor.submit('create_image', instance, client.create_image,
+                            InstanceId=instance, 
+                            Name="Lambda - {} from {}".format(instance, now), 
+                            Description="Lambda created AMI of instance {} from {}".format(instance, now), 
+                            TagSpecifications=[{'ResourceType': 'image', 'Tags': [{'Key': 'Name', 'Value': instance_names[instance]}]}],
+                            NoReboot=True, 
+                            DryRun=False)
         else:
             logger.info("Instance {} - still 'valid'. no action required".format(instance))
             creating = "false"
             
-        if difference.total_seconds() / 3600 > hours_between_amis + 1 and creating == "false":
+        if difference.total_seconds() / 3600 > hours_between_amis + 1 and creating == "false" and not DRY_RUN:
             hours_since_last_ami = difference.total_seconds() / 3600
-            update_sns(instance, hours_since_last_ami)
+            alerts.append({'account': account_id, 'region': client.meta.region_name, 'instance': instance,
+                           'name': instance_names[instance], 'hours': hours_since_last_ami})
         
     # Delete the oldest AMI if we exceed retention policy
-    for instance, snapshots in instance_dictionary.items():
-        ami_to_keep = COPIES_TO_KEEP - 1
-        indices_to_keep = list(range(ami_to_keep)) + list(range(ami_to_keep, len(snapshots), 7))
-        for index, ami in enumerate(snapshots):
-            if index not in indices_to_keep:
-                ami_id = ami.split(" ")[1]
-                try:
-                    client.deregister_image(DryRun=False, ImageId=ami_id)
-                    logger.info(f"AMI {ami_id} deregistered successfully.")
-                except ClientError as e:
-                    logger.warning(e)
-            else:
-                logger.info(f"AMI {ami.split(' ')[1]} is kept.")
-        # for ami in snapshots[ami_to_keep:]:
-        #     ami_id = ami.split(" ")[1]
-        #     try:
-        #         ami_delete = client.deregister_image(DryRun=False, ImageId=ami_id)
-        #     except ClientError as e:
-        #         logger.warning(e)
+    plan = plan_retention(images_by_instance, COPIES_TO_KEEP, RETENTION_MODE, GFS_DAILY, GFS_WEEKLY, GFS_MONTHLY)
+    for instance, ami_id in plan.deletions():
+        executor.submit('deregister_image', ami_id, client.deregister_image, DryRun=False, ImageId=ami_id)
+    if DRY_RUN:
+        logger.info("Retention plan: {}".format(plan.to_json()))
                 
     # Delete orphaned snapshots
-    do_not_delete = False
-    for snapshot in snapshots_dict["Snapshots"]:
-        ami_parent = " "
-        # Get creation date from snapshot id
+    for snapshot in iter_snapshots(client):
         snapshot_id = snapshot["SnapshotId"]
-        try:
-            for tag in snapshot["Tags"]:
-                for key, value in tag.iteritems():
-                    if value or key == "DO NOT DELETE":
-                        do_not_delete = True
-                        continue
-                    else:
-                        logger.info("keeping Snapshot: {}".format(snapshot_id))
-        except:
-            pass
-        
-        if "Created by CreateImage" in snapshot["Description"] and do_not_delete == False:
-            snapshot_description = snapshot["Description"]
-            match = re.search("ami-.*", snapshot_description)
-            if match:
-                ami_parent = match.group().split(" ")[0]
-    
-            if ami_parent in ami_keep_list:
-                pass
-            else:
-                snapshot_object = resource.Snapshot(snapshot_id)
-                try:
-                    logger.debug("Deleting orphan snapshot {}".format(snapshot_object))
-                    response = snapshot_object.delete()
-                    logger.info(response)
-                except ClientError as e:
-                    logger.warning(e)
-        else:
+        if snapshot_id in snapshot_owners:
+            logger.debug("Snapshot {} belongs to {}".format(snapshot_id, snapshot_owners[snapshot_id]))
+            continue
+        if get_tag(snapshot, DO_NOT_DELETE_TAG) is not None:
+            logger.info("keeping Snapshot: {}".format(snapshot_id))
+            continue
+        # Snapshots of AMIs created during this run are not in the index yet
+        if snapshot["StartTime"] >= run_started:
             logger.info("Keeping Snapshot {}".format(snapshot["Description"]))
-            pass
+            continue
+
+        logger.debug("Deleting orphan snapshot {}".format(snapshot_id))
+        executor.submit('delete_snapshot', snapshot_id, client.delete_snapshot, SnapshotId=snapshot_id)
+
+    result = executor.wait()
+    summary = result.summary()
+    if store and not DRY_RUN:
+        state.forget(result.succeeded['deregister_image'])
+        store.save(state)
+    if DRY_RUN:
+        summary['retention'] = plan.to_dict()
+    logger.info("Batch summary for {}{}: {}".format(
+        client.meta.region_name, ' of account {}'.format(account_id) if account_id else '', json.dumps(summary)))
+    return summary, alerts
+
+
+def lambda_handler(event, context):
+    # Every region of every TARGET_ACCOUNTS account runs the whole pipeline with
+    # its own clients, so the run takes as long as the slowest of them
+    regions = AMI_REGIONS or [None]
+    targets = [(account_id, region) for account_id in list_accounts() for region in regions]
+    report = {}
+    alerts = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=min(len(targets), max(len(regions), FAN_OUT_WORKERS))) as pool:
+        futures = {target: pool.submit(rotate_region, target[1], target[0]) for target in targets}
+        for (account_id, region), future in futures.items():
+            name = region or 'default'
+            if account_id:
+                name = '{}/{}'.format(account_id, name)
+            try:
+                report[name], region_alerts = future.result()
+                alerts.extend(region_alerts)
+            except Exception as e:
+                logger.exception("Rotation failed in {}".format(name))
+                report[name] = {'error': str(e)}
+                failed.append(name)
+
+    if alerts and not DRY_RUN:
+        update_sns(alerts)
+    if failed:
+        raise RuntimeError("AMI rotation failed in {}".format(", ".join(failed)))
+    return report
 
 
 if __name__ == '__main__':
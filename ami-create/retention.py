@@ -0,0 +1,119 @@
+import json
+import calendar
+
+from datetime import datetime
+from datetime import timezone
+from collections import defaultdict
+
+AMI_NAME_PREFIX = 'Lambda - '
+CREATION_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+KEEP_EVERY = 7
+
+
+class AmiRecord:
+    __slots__ = ('image_id', 'instance_id', 'created')
+
+    def __init__(self, image_id, instance_id, created):
+        self.image_id = image_id
+        self.instance_id = instance_id
+        self.created = created
+
+    @classmethod
+    def from_image(cls, image):
+        # Lambda AMIs are named "Lambda - <instance id> from <date>"
+        name = image.get('Name', '')
+        if not name.startswith(AMI_NAME_PREFIX):
+            return None
+        parts = name.split(' ')
+        if len(parts) < 3:
+            return None
+        created = datetime.strptime(image['CreationDate'][:19], CREATION_DATE_FORMAT)
+        return cls(image['ImageId'], parts[2], calendar.timegm(created.timetuple()))
+
+    def to_dict(self):
+        return {
+            'image_id': self.image_id,
+            'created': datetime.fromtimestamp(self.created, timezone.utc).isoformat(),
+        }
+
+
+def keep_count(records, copies_to_keep, every=KEEP_EVERY):
+    # The newest copies_to_keep - 1 AMIs plus every 7th one from there on
+    image_ids = [record.image_id for record in records]
+    head = max(copies_to_keep - 1, 0)
+    return set(image_ids[:head]) | set(image_ids[head::every])
+
+
+def keep_gfs(records, daily, weekly, monthly):
+    # Newest AMI of each of the latest N days, ISO weeks and months
+    dates = [datetime.fromtimestamp(record.created, timezone.utc) for record in records]
+    tiers = (
+        (daily, lambda created: (created.year, created.month, created.day)),
+        (weekly, lambda created: created.isocalendar()[:2]),
+        (monthly, lambda created: (created.year, created.month)),
+    )
+    keep = set()
+    for count, bucket in tiers:
+        seen = set()
+        for record, created in zip(records, dates):
+            if len(seen) >= count:
+                break
+            key = bucket(created)
+            if key not in seen:
+                seen.add(key)
+                keep.add(record.image_id)
+    return keep
+
+
+class RetentionPlan:
+    def __init__(self):
+        self.keep = {}
+        self.delete = {}
+        self._records = {}
+
+    def add(self, instance_id, records, keep_ids):
+        all_ids = {record.image_id for record in records}
+        delete_ids = all_ids - keep_ids
+        self._records.update((record.image_id, record) for record in records)
+        self.keep[instance_id] = keep_ids & all_ids
+        self.delete[instance_id] = delete_ids
+
+    def deletions(self):
+        for instance_id, image_ids in self.delete.items():
+            for image_id in sorted(image_ids):
+                yield instance_id, image_id
+
+    def to_dict(self):
+        def records(image_ids):
+            return [record.to_dict() for record in sorted((self._records[image_id] for image_id in image_ids),
+                                                          key=lambda record: record.created, reverse=True)]
+        return {
+            instance_id: {'keep': records(self.keep[instance_id]), 'delete': records(self.delete[instance_id])}
+            for instance_id in self.keep
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4, sort_keys=True)
+
+
+def group_images(images, instance_ids):
+    # Parses each image once into an AmiRecord, grouped by instance and sorted newest first
+    grouped = defaultdict(list)
+    for image in images:
+        record = AmiRecord.from_image(image)
+        if record and record.instance_id in instance_ids:
+            grouped[record.instance_id].append(record)
+    for records in grouped.values():
+        records.sort(key=lambda record: record.created, reverse=True)
+    return grouped
+
+
+def plan_retention(grouped, copies_to_keep, mode='count', daily=7, weekly=4, monthly=12):
+    plan = RetentionPlan()
+    for instance_id, records in grouped.items():
+        if mode == 'gfs':
+            keep_ids = keep_gfs(records, daily, weekly, monthly)
+        else:
+            keep_ids = keep_count(records, copies_to_keep)
+        plan.add(instance_id, records, keep_ids)
+    return plan
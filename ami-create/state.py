@@ -0,0 +1,100 @@
+import json
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from blobs import open_blob_store
+
+STATE_VERSION = 1
+MAX_INCREMENTAL_DAYS = 30
+
+
+class ImageState:
+    """Owned images seen by previous runs, kept as compact
+    [name, creation date, snapshot ids] entries keyed by AMI id."""
+
+    def __init__(self, images=None, last_sync=0, last_reconcile=0):
+        self.images = images or {}
+        self.last_sync = last_sync
+        self.last_reconcile = last_reconcile
+
+    def needs_reconcile(self, now, reconcile_hours):
+        if not self.last_reconcile or not self.last_sync:
+            return True
+        if now - self.last_sync > MAX_INCREMENTAL_DAYS * 86400:
+            return True
+        return now - self.last_reconcile >= reconcile_hours * 3600
+
+    def creation_date_patterns(self, now):
+        # describe_images has no range filter on creation-date, so every UTC day
+        # since the last sync (inclusive) becomes a wildcard value
+        day = datetime.fromtimestamp(self.last_sync, timezone.utc).date()
+        today = datetime.fromtimestamp(now, timezone.utc).date()
+        patterns = []
+        while day <= today:
+            patterns.append('{}T*'.format(day.isoformat()))
+            day += timedelta(days=1)
+        return patterns
+
+    def sync(self, images, now, full):
+        # Stores the listed images and yields every known image, listed ones first
+        if full:
+            self.images = {}
+            self.last_reconcile = now
+        listed = set()
+        for image in images:
+            listed.add(image['ImageId'])
+            self.images[image['ImageId']] = [
+                image.get('Name', ''),
+                image.get('CreationDate', ''),
+                [mapping['Ebs']['SnapshotId'] for mapping in image.get('BlockDeviceMappings', [])
+                 if mapping.get('Ebs', {}).get('SnapshotId')],
+            ]
+            yield image
+        for image_id, (name, creation_date, snapshot_ids) in self.images.items():
+            if image_id not in listed:
+                yield {
+                    'ImageId': image_id,
+                    'Name': name,
+                    'CreationDate': creation_date,
+                    'BlockDeviceMappings': [{'Ebs': {'SnapshotId': snapshot_id}} for snapshot_id in snapshot_ids],
+                }
+        self.last_sync = now
+
+    def forget(self, image_ids):
+        for image_id in image_ids:
+            self.images.pop(image_id, None)
+
+    def to_json(self):
+        return json.dumps({
+            'version': STATE_VERSION,
+            'last_sync': self.last_sync,
+            'last_reconcile': self.last_reconcile,
+            'images': self.images,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, body):
+        data = json.loads(body)
+        if data.get('version') != STATE_VERSION:
+            return None
+        return cls(data['images'], data['last_sync'], data['last_reconcile'])
+
+
+class StateStore:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def load(self):
+        body, _ = self.blobs.read()
+        return None if body is None else ImageState.from_json(body)
+
+    def save(self, state):
+        self.blobs.write('', state.to_json().encode())
+
+
+def open_state_store(uri):
+    # Empty disables the state store
+    blobs = open_blob_store(uri)
+    return StateStore(blobs) if blobs else None
@@ -0,0 +1,95 @@
+"""Checks which AMIs the retention planner keeps and deregisters.
+
+Runs without AWS access: python3 test_retention.py
+"""
+import os
+import sys
+
+from datetime import datetime
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from retention import group_images
+from retention import keep_count
+from retention import keep_gfs
+from retention import plan_retention
+
+INSTANCE = 'i-0123456789abcdef0'
+# A daily AMI at 10:00 UTC from 2024-01-01 (a Monday) to 2024-03-31, newest first after grouping
+START = datetime(2024, 1, 1, 10, 0, 0)
+DAYS = 91
+
+
+def image(day):
+    created = START + timedelta(days=day)
+    return {
+        'ImageId': 'ami-{:03d}'.format(day),
+        'Name': 'Lambda - {} from {}'.format(INSTANCE, created.strftime('%Y-%m-%dT%H.%M.%S')),
+        'CreationDate': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+    }
+
+
+def images():
+    return [image(day) for day in range(DAYS)]
+
+
+def ids(*days):
+    return {'ami-{:03d}'.format(day) for day in days}
+
+
+def test_group_images_sorts_newest_first_and_skips_foreign_images():
+    foreign = [
+        {'ImageId': 'ami-manual', 'Name': 'manual backup', 'CreationDate': '2024-03-31T12:00:00.000Z'},
+        dict(image(0), ImageId='ami-other', Name='Lambda - i-other from 2024-01-01T10.00.00'),
+    ]
+    grouped = group_images(images() + foreign, {INSTANCE})
+    assert list(grouped) == [INSTANCE]
+    records = grouped[INSTANCE]
+    assert [record.image_id for record in records[:3]] == ['ami-090', 'ami-089', 'ami-088']
+    assert records[-1].image_id == 'ami-000'
+
+
+def test_keep_count_keeps_newest_and_every_seventh():
+    records = group_images(images(), {INSTANCE})[INSTANCE]
+    # Newest 9 (days 90..82), then every 7th from the 10th newest (day 81) on
+    expected = ids(*range(82, 91)) | ids(*range(81, -1, -7))
+    assert keep_count(records, 10) == expected
+
+
+def test_keep_count_with_fewer_images_than_copies_keeps_all():
+    records = group_images(images()[-5:], {INSTANCE})[INSTANCE]
+    assert keep_count(records, 10) == ids(*range(86, 91))
+
+
+def test_keep_gfs_daily_weekly_monthly():
+    records = group_images(images(), {INSTANCE})[INSTANCE]
+    keep = keep_gfs(records, daily=3, weekly=2, monthly=3)
+    # Days: March 31, 30 and 29. Weeks: Sunday March 31 ends its ISO week, the
+    # newest of the week before is Sunday March 24. Months: March 31, Feb 29, Jan 31
+    assert keep == ids(90, 89, 88, 83, 59, 30)
+
+
+def test_plan_retention_deregisters_everything_else():
+    grouped = group_images(images(), {INSTANCE})
+    plan = plan_retention(grouped, 10)
+    kept = plan.keep[INSTANCE]
+    deleted = {image_id for _, image_id in plan.deletions()}
+    assert kept == keep_count(grouped[INSTANCE], 10)
+    assert kept.isdisjoint(deleted)
+    assert kept | deleted == ids(*range(DAYS))
+    assert 'ami-080' in deleted and 'ami-081' in kept
+
+
+def test_plan_retention_gfs_mode():
+    grouped = group_images(images(), {INSTANCE})
+    plan = plan_retention(grouped, 10, 'gfs', daily=3, weekly=2, monthly=3)
+    assert plan.keep[INSTANCE] == ids(90, 89, 88, 83, 59, 30)
+    assert len(list(plan.deletions())) == DAYS - 6
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('ok', name)
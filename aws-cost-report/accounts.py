@@ -0,0 +1 @@
+../shared/accounts.py
\ No newline at end of file
@@ -0,0 +1,73 @@
+import heapq
+
+from array import array
+
+METRIC = 'UnblendedCost'
+
+
+class CostTable:
+    """DAILY Cost Explorer groups parsed once into columns.
+
+    Every row is (day index, group key index, amount) held in compact arrays,
+    so totals for any day range are computed without touching the raw
+    Cost Explorer strings again.
+    """
+
+    def __init__(self):
+        self.days = []
+        self.keys = []
+        self.day_rows = array('i')
+        self.key_rows = array('i')
+        self.amounts = array('d')
+        self._day_index = {}
+        self._key_index = {}
+
+    def add(self, day, keys, amount):
+        day_index = self._day_index.get(day)
+        if day_index is None:
+            day_index = self._day_index[day] = len(self.days)
+            self.days.append(day)
+        key_index = self._key_index.get(keys)
+        if key_index is None:
+            key_index = self._key_index[keys] = len(self.keys)
+            self.keys.append(keys)
+        self.day_rows.append(day_index)
+        self.key_rows.append(key_index)
+        self.amounts.append(amount)
+
+    def _day_mask(self, start, end):
+        # Days are ISO formatted so string comparison orders them
+        return [start <= day < end for day in self.days]
+
+    def total(self, start, end):
+        mask = self._day_mask(start, end)
+        return sum(amount for day_index, amount in zip(self.day_rows, self.amounts) if mask[day_index])
+
+    def by_group(self, start, end):
+        mask = self._day_mask(start, end)
+        totals = array('d', bytes(8 * len(self.keys)))
+        for day_index, key_index, amount in zip(self.day_rows, self.key_rows, self.amounts):
+            if mask[day_index]:
+                totals[key_index] += amount
+        return totals
+
+    def groups(self, start, end):
+        totals = self.by_group(start, end)
+        for index, amount in enumerate(totals):
+            if amount:
+                yield self.keys[index], amount
+
+    def top_groups(self, start, end, count, minimum=0.0):
+        # Only the count largest groups above minimum are selected, no full sort
+        totals = self.by_group(start, end)
+        indices = (index for index in range(len(totals)) if totals[index] > minimum)
+        return [(self.keys[index], totals[index]) for index in heapq.nlargest(count, indices, key=totals.__getitem__)]
+
+
+def build_table(results):
+    table = CostTable()
+    for entry in results:
+        day = entry['TimePeriod']['Start']
+        for group in entry.get('Groups', []):
+            table.add(day, tuple(group['Keys']), float(group['Metrics'][METRIC]['Amount']))
+    return table
@@ -0,0 +1 @@
+../shared/blobs.py
\ No newline at end of file
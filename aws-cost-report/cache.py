@@ -0,0 +1,85 @@
+import hashlib
+import datetime
+
+from blobs import open_blob_store
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def open_cache(uri, source='ce'):
+    # Empty disables caching
+    blobs = open_blob_store(uri)
+    return CostCache(blobs, source) if blobs else None
+
+
+def period_starts(time_period, granularity):
+    # Start date of every DAILY or MONTHLY period in [Start, End)
+    day = datetime.datetime.strptime(time_period['Start'], DATE_FORMAT).date()
+    end = datetime.datetime.strptime(time_period['End'], DATE_FORMAT).date()
+    if granularity == 'MONTHLY':
+        day = day.replace(day=1)
+    while day < end:
+        yield day.strftime(DATE_FORMAT)
+        if granularity == 'MONTHLY':
+            day = (day + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            day += datetime.timedelta(days=1)
+
+
+def merge_results(results):
+    # Cost Explorer pages repeat a TimePeriod with the next slice of its groups
+    merged = {}
+    for entry in results:
+        start = entry['TimePeriod']['Start']
+        if start not in merged:
+            merged[start] = {'TimePeriod': entry['TimePeriod'], 'Total': entry.get('Total', {}),
+                             'Groups': [], 'Estimated': False}
+        merged[start]['Groups'].extend(entry.get('Groups', []))
+        merged[start]['Estimated'] = merged[start]['Estimated'] or entry.get('Estimated', False)
+    return merged
+
+
+def group_by_slug(group_by):
+    name = ','.join('{}:{}'.format(group['Type'], group['Key']) for group in group_by)
+    return hashlib.sha1(name.encode()).hexdigest()[:12]
+
+
+class CostCache:
+    """Cost results stored per (source, granularity, group-by, period start).
+
+    Periods the source reports as final are never requested again, only
+    missing and still estimated periods are fetched.
+    """
+
+    def __init__(self, blobs, source='ce'):
+        self.blobs = blobs
+        self.source = source
+
+    def _key(self, granularity, group_by, start):
+        return '{}/{}/{}/{}.json'.format(self.source, granularity, group_by_slug(group_by), start)
+
+    def get_results(self, fetch, time_period, granularity, group_by):
+        starts = list(period_starts(time_period, granularity))
+        cached = {start: self.blobs.load(self._key(granularity, group_by, start)) for start in starts}
+        stale = [start for start in starts if cached[start] is None or cached[start].get('Estimated')]
+        print("Cost cache: {} of {} {} periods to fetch".format(len(stale), len(starts), granularity))
+
+        for requested_period in contiguous_periods(stale, starts, time_period['End']):
+            fetched = merge_results(fetch(requested_period, granularity, group_by))
+            for start, entry in fetched.items():
+                self.blobs.save(self._key(granularity, group_by, start), entry)
+                cached[start] = entry
+        return [cached[start] for start in starts if cached[start] is not None]
+
+
+def contiguous_periods(stale, starts, end):
+    # Runs of adjacent stale periods become one request each
+    stale = set(stale)
+    run_start = None
+    for index, start in enumerate(starts):
+        if start in stale and run_start is None:
+            run_start = start
+        if run_start is not None and (start not in stale or index == len(starts) - 1):
+            run_end = end if start in stale else start
+            yield {"Start": run_start, "End": run_end}
+            run_start = None
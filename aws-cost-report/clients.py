@@ -0,0 +1 @@
+../shared/clients.py
\ No newline at end of file
@@ -0,0 +1,130 @@
+import os
+import datetime
+
+from collections import defaultdict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+DATE_FORMAT = "%Y-%m-%d"
+USAGE_DATE_COLUMN = 'line_item_usage_start_date'
+COST_COLUMN = 'line_item_unblended_cost'
+# Cost Explorer GroupBy keys and the CUR columns holding the same values
+DIMENSION_COLUMNS = {
+    'LINKED_ACCOUNT': 'line_item_usage_account_id',
+    'SERVICE': 'product_product_name',
+    'REGION': 'product_region',
+    'USAGE_TYPE': 'line_item_usage_type',
+    'INSTANCE_TYPE': 'product_instance_type',
+}
+BATCH_SIZE = 64 * 1024
+# A month can still be restated until its bill is finalized early in the next month
+RESTATEMENT_DAYS = 5
+
+
+class CurReader:
+    """Cost and Usage Report Parquet files as a Cost Explorer replacement.
+
+    Only the needed columns are read, the usage date (and the year/month
+    partitions CUR writes) are pushed down to the scan and record batches are
+    aggregated one at a time, so memory depends on the number of groups and
+    not on the size of the report files.
+    """
+
+    def __init__(self, uri, service_column=None, batch_size=BATCH_SIZE, restatement_days=RESTATEMENT_DAYS):
+        if '://' not in uri:
+            self.fs, self.root = pafs.LocalFileSystem(), os.path.abspath(uri)
+        else:
+            self.fs, self.root = pafs.FileSystem.from_uri(uri)
+        self.batch_size = batch_size
+        self.restatement_days = restatement_days
+        self.dimension_columns = dict(DIMENSION_COLUMNS)
+        if service_column:
+            self.dimension_columns['SERVICE'] = service_column
+
+    def _column(self, group):
+        if group['Type'] == 'TAG':
+            return 'resource_tags_user_{}'.format(group['Key'])
+        return self.dimension_columns[group['Key']]
+
+    def get_report(self, time_period, granularity, group_by, accounts=None):
+        start = datetime.datetime.strptime(time_period['Start'], DATE_FORMAT)
+        end = datetime.datetime.strptime(time_period['End'], DATE_FORMAT)
+        columns = [self._column(group) for group in group_by]
+        # Cost Explorer returns tag groups as key$value
+        prefixes = ['{}$'.format(group['Key']) if group['Type'] == 'TAG' else '' for group in group_by]
+
+        dataset = ds.dataset(self.root, filesystem=self.fs, format='parquet', partitioning='hive',
+                             exclude_invalid_files=True)
+        usage_type = dataset.schema.field(USAGE_DATE_COLUMN).type
+        condition = ((ds.field(USAGE_DATE_COLUMN) >= pa.scalar(start, usage_type))
+                     & (ds.field(USAGE_DATE_COLUMN) < pa.scalar(end, usage_type)))
+        if {'year', 'month'} <= set(dataset.schema.names):
+            months = {(start.year, start.month)}
+            day = start
+            while day < end:
+                months.add((day.year, day.month))
+                day += datetime.timedelta(days=1)
+            month_condition = None
+            for year, month in months:
+                partition = (ds.field('year') == year) & (ds.field('month') == month)
+                month_condition = partition if month_condition is None else month_condition | partition
+            condition = condition & month_condition
+        if accounts:
+            condition = condition & ds.field(DIMENSION_COLUMNS['LINKED_ACCOUNT']).isin(accounts)
+
+        scanner = dataset.scanner(columns=[USAGE_DATE_COLUMN, COST_COLUMN] + columns, filter=condition,
+                                  batch_size=self.batch_size, batch_readahead=2, fragment_readahead=1)
+        totals = defaultdict(float)
+        for batch in scanner.to_batches():
+            if not batch.num_rows:
+                continue
+            usage_date = pc.cast(batch.column(USAGE_DATE_COLUMN), pa.date32())
+            if granularity == 'MONTHLY':
+                usage_date = pc.strftime(usage_date, '%Y-%m-01')
+            else:
+                usage_date = pc.strftime(usage_date, DATE_FORMAT)
+            table = pa.table([usage_date, pc.cast(batch.column(COST_COLUMN), pa.float64())]
+                             + [pc.cast(batch.column(column), pa.string()) for column in columns],
+                             names=['period', 'cost'] + columns)
+            grouped = table.group_by(['period'] + columns).aggregate([('cost', 'sum')])
+            for row in grouped.to_pylist():
+                keys = tuple(prefix + (row[column] or '') for prefix, column in zip(prefixes, columns))
+                totals[(row['period'],) + keys] += row['cost_sum']
+
+        return to_results(totals, granularity, finalized_before(datetime.date.today(), self.restatement_days))
+
+
+def finalized_before(today, restatement_days):
+    # Periods ending on or before this date are no longer restated
+    month_start = today.replace(day=1)
+    if today.day > restatement_days:
+        return month_start
+    return (month_start - datetime.timedelta(days=1)).replace(day=1)
+
+
+def to_results(totals, granularity, final_until):
+    # Same ResultsByTime layout Cost Explorer returns, one entry per period, the
+    # ones that may still change are Estimated so the cost cache fetches them again
+    periods = defaultdict(list)
+    for keys, amount in totals.items():
+        periods[keys[0]].append({
+            'Keys': list(keys[1:]),
+            'Metrics': {'UnblendedCost': {'Amount': repr(amount), 'Unit': 'USD'}},
+        })
+    results = []
+    for start in sorted(periods):
+        day = datetime.datetime.strptime(start, DATE_FORMAT).date()
+        if granularity == 'MONTHLY':
+            end = (day + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            end = day + datetime.timedelta(days=1)
+        results.append({
+            'TimePeriod': {'Start': start, 'End': end.strftime(DATE_FORMAT)},
+            'Total': {},
+            'Groups': periods[start],
+            'Estimated': end > final_until,
+        })
+    return results
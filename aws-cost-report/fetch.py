@@ -0,0 +1,107 @@
+import time
+import datetime
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class RateLimiter:
+    """Token bucket shared by every Cost Explorer call of the process."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def shard_period(time_period, granularity, shard_days):
+    # DAILY periods are split into shard_days long ranges, MONTHLY ones are kept whole
+    start = datetime.datetime.strptime(time_period['Start'], DATE_FORMAT).date()
+    end = datetime.datetime.strptime(time_period['End'], DATE_FORMAT).date()
+    if granularity != 'DAILY' or shard_days <= 0:
+        return [time_period]
+    shards = []
+    while start < end:
+        shard_end = min(end, start + datetime.timedelta(days=shard_days))
+        shards.append({"Start": start.strftime(DATE_FORMAT), "End": shard_end.strftime(DATE_FORMAT)})
+        start = shard_end
+    return shards
+
+
+class CostExplorerFetcher:
+    """Fetches get_cost_and_usage results with date shards on a thread pool.
+
+    Pages of one shard still follow NextPageToken in order, every request
+    waits on the shared rate limiter first.
+    """
+
+    def __init__(self, client, limiter, workers=4, shard_days=14, metrics=("UnblendedCost",)):
+        self.client = client
+        self.limiter = limiter
+        self.workers = workers
+        self.shard_days = shard_days
+        self.metrics = list(metrics)
+
+    def _fetch_shard(self, time_period, granularity, group_by):
+        results = []
+        token = None
+        while True:
+            kwargs = {"NextPageToken": token} if token else {}
+            self.limiter.acquire()
+            data = self.client.get_cost_and_usage(
+                TimePeriod=time_period,
+                Granularity=granularity,
+                Metrics=self.metrics,
+                GroupBy=group_by,
+                **kwargs
+            )
+            results += data["ResultsByTime"]
+            token = data.get("NextPageToken")
+            if not token:
+                return results
+
+    def get_report(self, time_period, granularity, group_by):
+        shards = shard_period(time_period, granularity, self.shard_days)
+        if len(shards) == 1:
+            return self._fetch_shard(shards[0], granularity, group_by)
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(shards))) as pool:
+            futures = [pool.submit(self._fetch_shard, shard, granularity, group_by) for shard in shards]
+            return [entry for future in futures for entry in future.result()]
+
+
+def fetch_queries(fetch, queries, time_period, granularity):
+    # Runs every named group-by query at the same time, fetch is
+    # fetch(time_period, granularity, group_by)
+    with ThreadPoolExecutor(max_workers=max(len(queries), 1)) as pool:
+        futures = {name: pool.submit(fetch, time_period, granularity, group_by) for name, group_by in queries.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def parse_breakdowns(value):
+    # "REGION,USAGE_TYPE,TAG:team" -> {name: GroupBy}
+    queries = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.upper().startswith('TAG:'):
+            queries[item] = [{"Type": "TAG", "Key": item[len('TAG:'):]}]
+        else:
+            queries[item.upper()] = [{"Type": "DIMENSION", "Key": item.upper()}]
+    return queries
@@ -0,0 +1,129 @@
+import os
+import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+METRIC = 'UnblendedCost'
+SCHEMA = pa.schema([
+    ('date', pa.date32()),
+    ('account', pa.string()),
+    ('service', pa.string()),
+    ('amount', pa.float64()),
+    ('estimated', pa.bool_()),
+])
+
+
+def results_to_frame(results):
+    rows = {name: [] for name in SCHEMA.names}
+    for entry in results:
+        day = datetime.date.fromisoformat(entry['TimePeriod']['Start'])
+        estimated = entry.get('Estimated', False)
+        for group in entry.get('Groups', []):
+            rows['date'].append(day)
+            rows['account'].append(group['Keys'][0])
+            rows['service'].append(group['Keys'][1])
+            rows['amount'].append(float(group['Metrics'][METRIC]['Amount']))
+            rows['estimated'].append(estimated)
+    return pa.Table.from_pydict(rows, schema=SCHEMA)
+
+
+class HistoryStore:
+    """Daily account x service costs as Parquet, one month=YYYY-MM partition per month.
+
+    The uri is anything pyarrow.fs understands, s3://bucket/prefix or a local
+    directory.
+    """
+
+    def __init__(self, uri):
+        # A local directory may be relative, file:// URIs need an absolute path
+        if '://' not in uri:
+            self.fs, self.root = pafs.LocalFileSystem(), os.path.abspath(uri)
+        else:
+            self.fs, self.root = pafs.FileSystem.from_uri(uri)
+
+    def _path(self, month):
+        return '{}/month={}/part-0.parquet'.format(self.root, month)
+
+    def write(self, results):
+        # Rewrites the touched month partitions with the new days replacing old ones
+        table = results_to_frame(results)
+        if not table.num_rows:
+            return
+        frame = table.to_pandas()
+        frame['month'] = pd.to_datetime(frame['date']).dt.strftime('%Y-%m')
+        for month, rows in frame.groupby('month'):
+            rows = rows.drop(columns='month')
+            path = self._path(month)
+            if self.fs.get_file_info(path).type != pafs.FileType.NotFound:
+                existing = pq.read_table(path, filesystem=self.fs).to_pandas()
+                existing = existing[~existing['date'].isin(set(rows['date']))]
+                rows = pd.concat([existing, rows], ignore_index=True)
+            self.fs.create_dir('{}/month={}'.format(self.root, month), recursive=True)
+            pq.write_table(pa.Table.from_pandas(rows, schema=SCHEMA, preserve_index=False), path,
+                           filesystem=self.fs, compression='zstd')
+
+    def read(self, start, end):
+        # Days in [start, end), only the partitions of the months involved are opened
+        months = pd.period_range(start, pd.Timestamp(end) - pd.Timedelta(days=1), freq='M').strftime('%Y-%m')
+        paths = [self._path(month) for month in months
+                 if self.fs.get_file_info(self._path(month)).type != pafs.FileType.NotFound]
+        if not paths:
+            return SCHEMA.empty_table().to_pandas()
+        dataset = ds.dataset(paths, schema=SCHEMA, format='parquet', filesystem=self.fs)
+        condition = (ds.field('date') >= pa.scalar(start, pa.date32())) & (ds.field('date') < pa.scalar(end, pa.date32()))
+        frame = dataset.to_table(filter=condition).to_pandas()
+        frame['date'] = pd.to_datetime(frame['date'])
+        frame['account'] = frame['account'].astype('category')
+        frame['service'] = frame['service'].astype('category')
+        return frame
+
+
+def daily_matrix(frame, by, start, end):
+    # date x key matrix of daily costs with missing days filled with zero
+    matrix = frame.pivot_table(index='date', columns=by, values='amount', aggfunc='sum', observed=True)
+    days = pd.date_range(start, pd.Timestamp(end) - pd.Timedelta(days=1), freq='D')
+    return matrix.reindex(days, fill_value=0.0).fillna(0.0)
+
+
+def rolling_averages(frame, by, start, end, windows=(7, 30)):
+    # Last day's amount, day-over-day delta and rolling means per service or account
+    matrix = daily_matrix(frame, by, start, end)
+    if matrix.empty:
+        return pd.DataFrame()
+    result = pd.DataFrame({
+        'amount': matrix.iloc[-1],
+        'delta': matrix.iloc[-1] - (matrix.iloc[-2] if len(matrix) > 1 else 0.0),
+    })
+    for window in windows:
+        result['avg_{}d'.format(window)] = matrix.iloc[-window:].mean()
+    order = np.lexsort((-result['amount'].to_numpy(), -result['delta'].abs().to_numpy()))
+    return result.iloc[order]
+
+
+def forecast_month_end(frame, today, window=7):
+    # Month-to-date cost plus the recent daily average for the days left in the month
+    start_of_month = pd.Timestamp(today).replace(day=1)
+    days_in_month = start_of_month.days_in_month
+    totals = frame.groupby('date')['amount'].sum()
+    totals = totals.reindex(pd.date_range(start_of_month - pd.Timedelta(days=window), pd.Timestamp(today) - pd.Timedelta(days=1)),
+                            fill_value=0.0)
+    month_to_date = totals[totals.index >= start_of_month].sum()
+    remaining_days = days_in_month - (pd.Timestamp(today) - start_of_month).days
+    return month_to_date + totals.iloc[-window:].mean() * remaining_days
+
+
+def trends(store, today, top_n):
+    start = today - datetime.timedelta(days=30)
+    frame = store.read(min(start, today.replace(day=1) - datetime.timedelta(days=7)), today)
+    if frame.empty:
+        return None
+    return {
+        'services': rolling_averages(frame, 'service', start, today).head(top_n),
+        'accounts': rolling_averages(frame, 'account', start, today).head(top_n),
+        'forecast': forecast_month_end(frame, today),
+    }
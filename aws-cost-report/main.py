@@ -4,15 +4,50 @@ import json
 import time
 import datetime
 
-import boto3
-
-from collections import defaultdict
-
 from botocore.exceptions import ClientError
 
+from cache import open_cache
+from clients import get_client
+from aggregate import build_table
+from fetch import RateLimiter
+from fetch import CostExplorerFetcher
+from fetch import fetch_queries
+from fetch import parse_breakdowns
+from render import CostReport
+from render import render
+from render import render_summary
+from render import fit_message
+
+COST_CACHE_URI = os.environ.get('COST_CACHE_URI', '')
+COST_HISTORY_URI = os.environ.get('COST_HISTORY_URI', '')
+SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:401144893760:ops-report')
+REPORT_TOP_N = int(os.environ.get('REPORT_TOP_N', '50'))
+REPORT_MINIMUM = float(os.environ.get('REPORT_MINIMUM', '1.00'))
+COST_BREAKDOWNS = os.environ.get('COST_BREAKDOWNS', '')
+COST_EXPLORER_RPS = float(os.environ.get('COST_EXPLORER_RPS', '5'))
+COST_FETCH_WORKERS = int(os.environ.get('COST_FETCH_WORKERS', '4'))
+COST_SHARD_DAYS = int(os.environ.get('COST_SHARD_DAYS', '14'))
+COST_DATA_SOURCE = os.environ.get('COST_DATA_SOURCE', 'ce').lower()
+CUR_URI = os.environ.get('CUR_URI', '')
+CUR_SERVICE_COLUMN = os.environ.get('CUR_SERVICE_COLUMN', '')
+CUR_RESTATEMENT_DAYS = int(os.environ.get('CUR_RESTATEMENT_DAYS', '5'))
+REPORT_BUCKET = os.environ.get('REPORT_BUCKET', '')
+REPORT_PREFIX = os.environ.get('REPORT_PREFIX', 'cost-reports')
+REPORT_FORMATS = {'txt': 'text/plain', 'html': 'text/html', 'csv': 'text/csv'}
+# SNS messages are limited to 256 KB
+SNS_MESSAGE_LIMIT = 256 * 1024 - 1024
+GROUP_BY = [
+    {"Type": "DIMENSION", "Key": "LINKED_ACCOUNT"},
+    {"Type": "DIMENSION", "Key": "SERVICE"},
+]
+REPORT_QUERY = "LINKED_ACCOUNT x SERVICE"
+
+# Every Cost Explorer request of a warm container goes through this limiter
+CE_LIMITER = RateLimiter(COST_EXPLORER_RPS)
+
 
 def get_secrets(key_name):
-    secretsmanager = boto3.client('secretsmanager', region_name='us-east-1')
+    secretsmanager = get_client('secretsmanager', 'us-east-1')
     response = secretsmanager.get_secret_value(SecretId='ops')
     return json.loads(response['SecretString'])['TOKEN']
     # return json.loads(response['SecretString'])
@@ -28,38 +63,29 @@ def abv(service_name):
             output = service_name[0:40]
     return output
 
-def get_report(requested_time_period, requested_granularity):
-    session = boto3.session.Session()
-    cd = session.client("ce", "us-east-1")
+def get_report(requested_time_period, requested_granularity, group_by=GROUP_BY):
+    # COST_DATA_SOURCE=cur reads the Cost and Usage Report Parquet files instead of Cost Explorer
+    if COST_DATA_SOURCE == 'cur':
+        from cur import CurReader
+        reader = CurReader(CUR_URI, CUR_SERVICE_COLUMN, restatement_days=CUR_RESTATEMENT_DAYS)
+        return reader.get_report(requested_time_period, requested_granularity, group_by)
 
-    results = []
+    cd = get_client("ce", "us-east-1", retries={"mode": "adaptive", "max_attempts": 10})
+    fetcher = CostExplorerFetcher(cd, CE_LIMITER, COST_FETCH_WORKERS, COST_SHARD_DAYS)
+    return fetcher.get_report(requested_time_period, requested_granularity, group_by)
 
-    token = None
-    while True:
-        if token:
-            kwargs = {"NextPageToken": token}
-        else:
-            kwargs = {}
-        data = cd.get_cost_and_usage(
-            TimePeriod=requested_time_period,
-            Granularity=requested_granularity,
-            Metrics=["UnblendedCost"],
-            GroupBy=[
-                {"Type": "DIMENSION", "Key": "LINKED_ACCOUNT"},
-                {"Type": "DIMENSION", "Key": "SERVICE"},
-            ],
-            **kwargs
-        )
-        results += data["ResultsByTime"]
-        token = data.get("NextPageToken")
-        if not token:
-            break
-    return results
+
+def get_cached_report(requested_time_period, requested_granularity, group_by=GROUP_BY):
+    # Goes through the cost cache when COST_CACHE_URI is set
+    cache = open_cache(COST_CACHE_URI, COST_DATA_SOURCE)
+    if not cache:
+        return get_report(requested_time_period, requested_granularity, group_by)
+    return cache.get_results(get_report, requested_time_period, requested_granularity, group_by)
 
 
 def send_to_sns(data_attachment, sns_topic_arn, cycle):
     # Create an SNS client
-    sns_client = boto3.client('sns', region_name='us-east-1')
+    sns_client = get_client('sns', 'us-east-1')
 
 
     # Publish the message to the specified SNS topic
@@ -71,118 +97,70 @@ def send_to_sns(data_attachment, sns_topic_arn, cycle):
 
     # Print the MessageId from the response
     print(f"MessageId: {response['MessageId']}")
-    
+
+
+def publish_report(report):
+    # With REPORT_BUCKET set the full text, HTML and CSV reports go to S3 and SNS only
+    # carries a summary with the links, otherwise the text report is sent as before
+    if not REPORT_BUCKET:
+        send_to_sns(fit_message(render(report, 'txt'), SNS_MESSAGE_LIMIT), SNS_TOPIC_ARN, report.cycle)
+        return
+
+    s3_client = get_client('s3')
+    links = {}
+    for fmt, content_type in REPORT_FORMATS.items():
+        key = "{}/{}/{}.{}".format(REPORT_PREFIX, report.cycle.lower(), report.start, fmt)
+        s3_client.put_object(Bucket=REPORT_BUCKET, Key=key, Body=render(report, fmt).encode('utf-8'),
+                             ContentType="{}; charset=utf-8".format(content_type))
+        links[fmt] = "https://s3.console.aws.amazon.com/s3/object/{}?prefix={}".format(REPORT_BUCKET, key)
+    send_to_sns(fit_message(render_summary(report, links), SNS_MESSAGE_LIMIT), SNS_TOPIC_ARN, report.cycle)
+
+
 def lambda_handler(event, context):
+    # {"backfill": {"Start": "YYYY-MM-DD", "End": "YYYY-MM-DD"}} fills the cache without sending a report
+    if event and "backfill" in event:
+        results = get_cached_report(event["backfill"], event.get("granularity", "DAILY"))
+        return {"periods": len(results)}
+
     now = datetime.datetime.utcnow()
-    start = (now - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    today = now.date()
+    yesterday = today - datetime.timedelta(days=1)
+    start_of_month = today.replace(day=1)
+    start_of_previous_month = (start_of_month - datetime.timedelta(days=1)).replace(day=1)
+
+    # One DAILY fetch from the start of the previous month feeds every report, the
+    # extra COST_BREAKDOWNS dimensions are fetched at the same time
+    queries = {REPORT_QUERY: GROUP_BY}
+    queries.update(parse_breakdowns(COST_BREAKDOWNS))
+    results_by_query = fetch_queries(get_cached_report, queries,
+                                     {"Start": start_of_previous_month.isoformat(), "End": today.isoformat()}, "DAILY")
+    results = results_by_query.pop(REPORT_QUERY)
+    table = build_table(results)
+    breakdowns = [(name, build_table(breakdown_results).top_groups(yesterday.isoformat(), today.isoformat(),
+                                                                   REPORT_TOP_N, REPORT_MINIMUM))
+                  for name, breakdown_results in results_by_query.items()]
+
+    # Every fetched day is kept in the Parquet history that the trend section reads
+    report_trends = None
+    if COST_HISTORY_URI:
+        # pandas and pyarrow are only imported when the history is enabled
+        from history import HistoryStore, trends
+        store = HistoryStore(COST_HISTORY_URI)
+        store.write(results)
+        report_trends = trends(store, today, REPORT_TOP_N)
+
+    previous_month_total = table.total(start_of_previous_month.isoformat(), start_of_month.isoformat())
+    month_to_date_total = table.total(start_of_month.isoformat(), today.isoformat())
 
-    end = now.strftime("%Y-%m-%d")
-    # First day of the month
-    start_of_month = now.replace(day=1).strftime("%Y-%m-%d")
-    start_of_previous_month = (now.replace(day=1) - datetime.timedelta(days=1)).replace(day=1).strftime("%Y-%m-%d")
+    if now.day == 2:
+        publish_report(CostReport("Monthly", start_of_previous_month.isoformat(), start_of_month.isoformat(), table,
+                                  REPORT_TOP_N, REPORT_MINIMUM))
 
-    # Last day of the month
-    end_of_month = (now.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
-    end_of_month_str = end_of_month.strftime("%Y-%m-%d")
-    end_of_previous_month = now.replace(day=1) - datetime.timedelta(days=1)
-    end_of_previous_month_str = end_of_previous_month.strftime("%Y-%m-%d")
+    publish_report(CostReport(
+        "Daily", yesterday.isoformat(), today.isoformat(), table, REPORT_TOP_N, REPORT_MINIMUM,
+        [("Month-to-date Cost", month_to_date_total), ("Previous Month Cost", previous_month_total)],
+        breakdowns, report_trends))
 
-    if now.day == 2:
-        requested_time_period = {"Start": start_of_previous_month, "End": end_of_previous_month_str}
-        requested_granularity = "MONTHLY"
-        results = get_report(requested_time_period, requested_granularity)
-
-            # Step 1: Extract and Separate the Information
-        time_periods = defaultdict(list)
-
-        for entry in results:
-            time_period = entry['TimePeriod']['Start']
-            groups = entry['Groups']
-            
-            time_periods[time_period].extend(groups)
-
-        # Step 2: Sort the Groups by UnblendedCost Amount
-        for time_period, groups in time_periods.items():
-            time_periods[time_period] = sorted(groups, key=lambda x: float(x['Metrics']['UnblendedCost']['Amount']), reverse=True)
-
-        # Step 3: Calculate the Total UnblendedCost for Each TimePeriod
-        for time_period, groups in time_periods.items():
-            total_cost = sum(float(group['Metrics']['UnblendedCost']['Amount']) for group in groups)
-            entry = {'Total': {'UnblendedCost': {'Amount': str(total_cost), 'Unit': 'USD'}}, 'Groups': groups}
-            time_periods[time_period] = entry
-
-        # sns_topic_arn = "arn:aws:sns:eu-central-1:214673208397:ops-reports"
-        sns_topic_arn = "arn:aws:sns:us-east-1:401144893760:ops-report"
-
-        email_body = """
-Monthly AWS cost report for the specified time period:
-        """
-
-        # Iterate through time_periods
-        for time_period, entry in time_periods.items():
-            email_body += f"\nTime Period: {time_period}\n"
-            email_body += f"Total Daily Cost: ${entry['Total']['UnblendedCost']['Amount']} USD\n"
-            email_body += "\nSorted Services:\n"
-
-            # Iterate through Groups
-            for group in entry['Groups']:
-                if float(group['Metrics']['UnblendedCost']['Amount']) > 1.00:
-                    email_body += f"- {group['Keys'][1]}: ${group['Metrics']['UnblendedCost']['Amount']} USD\n"
-
-        email_body += """
-Services costing more then $1.00 a day are listed above.
-        """
-        
-        send_to_sns(email_body, sns_topic_arn, "Monthly")
-
-
-    requested_time_period = {"Start": start, "End": end}
-    requested_granularity = "DAILY"
-    results = get_report(requested_time_period, requested_granularity)
-
-
-    # Step 1: Extract and Separate the Information
-    time_periods = defaultdict(list)
-
-    for entry in results:
-        time_period = entry['TimePeriod']['Start']
-        groups = entry['Groups']
-        
-        time_periods[time_period].extend(groups)
-
-    # Step 2: Sort the Groups by UnblendedCost Amount
-    for time_period, groups in time_periods.items():
-        time_periods[time_period] = sorted(groups, key=lambda x: float(x['Metrics']['UnblendedCost']['Amount']), reverse=True)
-
-    # Step 3: Calculate the Total UnblendedCost for Each TimePeriod
-    for time_period, groups in time_periods.items():
-        total_cost = sum(float(group['Metrics']['UnblendedCost']['Amount']) for group in groups)
-        entry = {'Total': {'UnblendedCost': {'Amount': str(total_cost), 'Unit': 'USD'}}, 'Groups': groups}
-        time_periods[time_period] = entry
-
-    # sns_topic_arn = "arn:aws:sns:eu-central-1:214673208397:ops-reports"
-    sns_topic_arn = "arn:aws:sns:us-east-1:401144893760:ops-report"
-
-    email_body = """
-Daily AWS cost report for the specified time period:
-    """
-
-    # Iterate through time_periods
-    for time_period, entry in time_periods.items():
-        email_body += f"\nTime Period: {time_period}\n"
-        email_body += f"Total Daily Cost: ${entry['Total']['UnblendedCost']['Amount']} USD\n"
-        email_body += "\nSorted Services:\n"
-
-        # Iterate through Groups
-        for group in entry['Groups']:
-            if float(group['Metrics']['UnblendedCost']['Amount']) > 1.00:
-                email_body += f"- {group['Keys'][1]}: ${group['Metrics']['UnblendedCost']['Amount']} USD\n"
-
-    email_body += """
-Services costing more then $1.00 a day are listed above.
-    """
-    
-    send_to_sns(email_body, sns_topic_arn, "Daily")
 
 if __name__ == '__main__':
     lambda_handler(None, None)
@@ -0,0 +1,127 @@
+import io
+import csv
+import html
+
+SUMMARY_TOP_N = 10
+TRUNCATED = "\n... report truncated, see the full report for every service.\n"
+
+
+class CostReport:
+    def __init__(self, cycle, start, end, table, top_n, minimum, totals=(), breakdowns=(), trends=None):
+        self.cycle = cycle
+        self.start = start
+        self.end = end
+        self.table = table
+        self.top_n = top_n
+        self.minimum = minimum
+        self.total = table.total(start, end)
+        self.groups = table.top_groups(start, end, top_n, minimum)
+        self.totals = totals
+        self.breakdowns = breakdowns
+        self.trends = trends
+
+
+def write_text(report, out):
+    out.write(f"\n{report.cycle} AWS cost report for the specified time period:\n")
+    out.write(f"\nTime Period: {report.start}\n")
+    out.write(f"Total {report.cycle} Cost: ${report.total:.2f} USD\n")
+    for label, amount in report.totals:
+        out.write(f"{label}: ${amount:.2f} USD\n")
+    out.write("\nSorted Services:\n")
+    for keys, amount in report.groups:
+        out.write(f"- {keys[1]}: ${amount:.2f} USD\n")
+
+    for title, groups in report.breakdowns:
+        out.write(f"\nTop {title}:\n")
+        for keys, amount in groups:
+            out.write(f"- {keys[-1] or 'No ' + title}: ${amount:.2f} USD\n")
+
+    if report.trends:
+        out.write(f"\nMonth-end Forecast: ${report.trends['forecast']:.2f} USD\n")
+        for title, frame in (("Service", report.trends['services']), ("Linked Account", report.trends['accounts'])):
+            out.write(f"\nLargest Daily Changes by {title}:\n")
+            for key, row in frame.iterrows():
+                out.write(f"- {key}: ${row['amount']:.2f} USD ({row['delta']:+.2f}, "
+                          f"7-day avg ${row['avg_7d']:.2f}, 30-day avg ${row['avg_30d']:.2f})\n")
+
+    out.write(f"\nTop {report.top_n} services costing more then ${report.minimum:.2f} are listed above.\n")
+
+
+def _html_rows(out, headers, rows):
+    out.write("<table><tr>")
+    for header in headers:
+        out.write(f"<th>{html.escape(header)}</th>")
+    out.write("</tr>\n")
+    for row in rows:
+        out.write("<tr>")
+        for cell in row:
+            out.write(f"<td>{html.escape(str(cell))}</td>")
+        out.write("</tr>\n")
+    out.write("</table>\n")
+
+
+def write_html(report, out):
+    out.write(f"<html><head><meta charset=\"utf-8\"><title>AWS {report.cycle} Cost Report</title></head><body>\n")
+    out.write(f"<h1>AWS {report.cycle} Cost Report - {html.escape(report.start)}</h1>\n")
+    _html_rows(out, ("", "USD"), [(f"Total {report.cycle} Cost", f"{report.total:.2f}")]
+               + [(label, f"{amount:.2f}") for label, amount in report.totals])
+    out.write("<h2>Sorted Services</h2>\n")
+    _html_rows(out, ("Linked Account", "Service", "USD"), ((keys[0], keys[1], f"{amount:.2f}") for keys, amount in report.groups))
+    for title, groups in report.breakdowns:
+        out.write(f"<h2>Top {html.escape(title)}</h2>\n")
+        _html_rows(out, (title, "USD"), ((keys[-1], f"{amount:.2f}") for keys, amount in groups))
+    if report.trends:
+        out.write(f"<h2>Month-end Forecast: ${report.trends['forecast']:.2f} USD</h2>\n")
+        for title, frame in (("Service", report.trends['services']), ("Linked Account", report.trends['accounts'])):
+            out.write(f"<h2>Largest Daily Changes by {title}</h2>\n")
+            _html_rows(out, (title, "USD", "Change", "7-day avg", "30-day avg"),
+                       ((key, f"{row['amount']:.2f}", f"{row['delta']:+.2f}", f"{row['avg_7d']:.2f}", f"{row['avg_30d']:.2f}")
+                        for key, row in frame.iterrows()))
+    out.write("</body></html>\n")
+
+
+def write_csv(report, out):
+    # Every group of the period, not only the listed ones
+    writer = csv.writer(out)
+    writer.writerow(("time_period", "linked_account", "service", "unblended_cost_usd"))
+    for keys, amount in report.table.groups(report.start, report.end):
+        writer.writerow((report.start, keys[0], keys[1], f"{amount:.6f}"))
+
+
+def write_summary(report, links, out):
+    out.write(f"\n{report.cycle} AWS cost report for {report.start}\n\n")
+    out.write(f"Total {report.cycle} Cost: ${report.total:.2f} USD\n")
+    for label, amount in report.totals:
+        out.write(f"{label}: ${amount:.2f} USD\n")
+    if report.trends:
+        out.write(f"Month-end Forecast: ${report.trends['forecast']:.2f} USD\n")
+    out.write(f"\nTop {min(SUMMARY_TOP_N, len(report.groups))} Services:\n")
+    for keys, amount in report.groups[:SUMMARY_TOP_N]:
+        out.write(f"- {keys[1]}: ${amount:.2f} USD\n")
+    out.write("\nFull report:\n")
+    for name, link in links.items():
+        out.write(f"- {name}: {link}\n")
+
+
+WRITERS = {'txt': write_text, 'html': write_html, 'csv': write_csv}
+
+
+def render(report, fmt):
+    buffer = io.StringIO()
+    WRITERS[fmt](report, buffer)
+    return buffer.getvalue()
+
+
+def render_summary(report, links):
+    buffer = io.StringIO()
+    write_summary(report, links, buffer)
+    return buffer.getvalue()
+
+
+def fit_message(message, limit):
+    # Cuts the message so its UTF-8 encoding stays under limit bytes
+    encoded = message.encode('utf-8')
+    if len(encoded) <= limit:
+        return message
+    cut = limit - len(TRUNCATED.encode('utf-8'))
+    return encoded[:cut].decode('utf-8', errors='ignore') + TRUNCATED
@@ -0,0 +1,73 @@
+"""Checks the period helpers of the cost cache and the CUR estimated periods.
+
+Runs without AWS access: python3 test_cost_cache.py
+"""
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache import CostCache
+from cache import contiguous_periods
+from cache import period_starts
+from cur import finalized_before
+from cur import to_results
+
+DAYS = ['2024-01-30', '2024-01-31', '2024-02-01', '2024-02-02', '2024-02-03']
+END = '2024-02-04'
+
+
+def test_period_starts_daily_and_monthly():
+    assert list(period_starts({'Start': '2024-01-30', 'End': END}, 'DAILY')) == DAYS
+    assert list(period_starts({'Start': '2023-12-15', 'End': '2024-03-01'}, 'MONTHLY')) == \
+        ['2023-12-01', '2024-01-01', '2024-02-01']
+
+
+def test_contiguous_periods_merges_adjacent_stale_days():
+    stale = ['2024-01-30', '2024-01-31', '2024-02-02']
+    assert list(contiguous_periods(stale, DAYS, END)) == [
+        {'Start': '2024-01-30', 'End': '2024-02-01'},
+        {'Start': '2024-02-02', 'End': '2024-02-03'},
+    ]
+
+
+def test_contiguous_periods_stale_tail_ends_at_period_end():
+    assert list(contiguous_periods(['2024-02-02', '2024-02-03'], DAYS, END)) == [
+        {'Start': '2024-02-02', 'End': END},
+    ]
+    assert list(contiguous_periods(DAYS, DAYS, END)) == [{'Start': DAYS[0], 'End': END}]
+
+
+def test_contiguous_periods_nothing_stale():
+    assert list(contiguous_periods([], DAYS, END)) == []
+
+
+def test_cache_keys_include_the_source():
+    group_by = [{'Type': 'DIMENSION', 'Key': 'SERVICE'}]
+    ce_key = CostCache(None, 'ce')._key('DAILY', group_by, '2024-01-30')
+    cur_key = CostCache(None, 'cur')._key('DAILY', group_by, '2024-01-30')
+    assert ce_key.startswith('ce/DAILY/') and cur_key.startswith('cur/DAILY/')
+    assert ce_key[len('ce'):] == cur_key[len('cur'):]
+
+
+def test_finalized_before_waits_out_the_restatement_window():
+    assert finalized_before(datetime.date(2024, 2, 3), 5) == datetime.date(2024, 1, 1)
+    assert finalized_before(datetime.date(2024, 2, 6), 5) == datetime.date(2024, 2, 1)
+    assert finalized_before(datetime.date(2024, 1, 2), 5) == datetime.date(2023, 12, 1)
+
+
+def test_cur_results_in_unfinalized_months_are_estimated():
+    totals = {('2024-01-31', 'Amazon EC2'): 1.5, ('2024-02-01', 'Amazon EC2'): 2.0}
+    results = to_results(totals, 'DAILY', datetime.date(2024, 2, 1))
+    assert [(entry['TimePeriod']['Start'], entry['Estimated']) for entry in results] == \
+        [('2024-01-31', False), ('2024-02-01', True)]
+    monthly = to_results({('2024-01-01', 'Amazon EC2'): 1.0}, 'MONTHLY', datetime.date(2024, 1, 1))
+    assert monthly[0]['Estimated']
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('ok', name)
@@ -0,0 +1,242 @@
+import os
+import time
+import random
+from collections import Counter
+
+from botocore.exceptions import ClientError
+from blobs import LocalBlobStore
+from clients import get_client
+
+
+def count_values(instances):
+    # instances maps instance id -> {dimension: value}
+    counts = {}
+    for values in instances.values():
+        for dimension, value in values.items():
+            counts.setdefault(dimension, Counter())[value] += 1
+    return counts
+
+
+class LocalCounterStore:
+    """Running instances kept in a JSON file, counts are derived on read."""
+
+    def __init__(self, path):
+        self.blobs = LocalBlobStore(path)
+        data = self.blobs.load() or {'instances': {}, 'claims': {}}
+        self.instances = data['instances']
+        self.claims = data['claims']
+
+    def _save(self):
+        self.blobs.save('', {'instances': self.instances, 'claims': self.claims})
+
+    def apply(self, instance_id, values):
+        # values None removes the instance, returns False when nothing changed
+        if values is None:
+            if self.instances.pop(instance_id, None) is None:
+                return False
+        elif instance_id in self.instances:
+            return False
+        else:
+            self.instances[instance_id] = values
+        self._save()
+        return True
+
+    def counts(self):
+        return count_values(self.instances)
+
+    def claim(self, name, now, interval):
+        if now - self.claims.get(name, 0) < interval:
+            return False
+        self.claims[name] = now
+        self._save()
+        return True
+
+    def claim_reconcile(self, now, interval):
+        return self.claim('reconcile', now, interval)
+
+    def replace(self, instances):
+        self.instances = dict(instances)
+        self._save()
+
+
+class DynamoCounterStore:
+    """Running instances and per-dimension counters in one DynamoDB table.
+
+    The table has a string partition key `kind` and a string sort key `key`.
+    Instance items are written together with their counter increments in one
+    transaction conditioned on the instance item, so a redelivered event can
+    never count an instance twice.
+    """
+
+    max_attempts = 6
+    base_delay = 0.05
+    max_delay = 2
+
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client or get_client('dynamodb')
+
+    def _query(self, kind):
+        paginator = self.client.get_paginator('query')
+        pages = paginator.paginate(
+            TableName=self.table,
+            KeyConditionExpression='#kind = :kind',
+            ExpressionAttributeNames={'#kind': 'kind'},
+            ExpressionAttributeValues={':kind': {'S': kind}},
+            ConsistentRead=True,
+        )
+        for page in pages:
+            yield from page['Items']
+
+    def _counter_update(self, dimension, value, delta):
+        return {'Update': {
+            'TableName': self.table,
+            'Key': {'kind': {'S': 'counter'}, 'key': {'S': '{}#{}'.format(dimension, value)}},
+            'UpdateExpression': 'SET #dimension = :dimension, #value = :value ADD #count :delta',
+            'ExpressionAttributeNames': {'#dimension': 'dimension', '#value': 'value', '#count': 'count'},
+            'ExpressionAttributeValues': {
+                ':dimension': {'S': dimension}, ':value': {'S': value}, ':delta': {'N': str(delta)},
+            },
+        }}
+
+    def _transact(self, items):
+        # The first item is the instance item: its failed condition means the event
+        # was already applied. A conflict with a concurrent transaction on a shared
+        # counter is retried, any other cancellation is raised
+        for attempt in range(self.max_attempts):
+            try:
+                self.client.transact_write_items(TransactItems=items)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    raise
+                reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+                if reasons and reasons[0] == 'ConditionalCheckFailed':
+                    return False
+                if 'TransactionConflict' not in reasons or attempt == self.max_attempts - 1:
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay))
+
+    def _change(self, instance_id, old, new):
+        # Moves the instance item from old to new values (None is no item) together with
+        # its counter deltas, conditioned on the item still holding old
+        key = {'kind': {'S': 'instance'}, 'key': {'S': instance_id}}
+        if old is None:
+            condition = {'ConditionExpression': 'attribute_not_exists(#kind)', 'ExpressionAttributeNames': {'#kind': 'kind'}}
+        else:
+            condition = {'ConditionExpression': '#values = :old', 'ExpressionAttributeNames': {'#values': 'values'},
+                         'ExpressionAttributeValues': {':old': instance_values(old)}}
+        if new is None:
+            item = {'Delete': dict(condition, TableName=self.table, Key=key)}
+        else:
+            item = {'Put': dict(condition, TableName=self.table, Item=dict(key, values=instance_values(new)))}
+        deltas = Counter()
+        for dimension, value in (old or {}).items():
+            deltas[(dimension, value)] -= 1
+        for dimension, value in (new or {}).items():
+            deltas[(dimension, value)] += 1
+        return self._transact([item] + [self._counter_update(dimension, value, delta)
+                                        for (dimension, value), delta in deltas.items() if delta])
+
+    def apply(self, instance_id, values):
+        if values is not None:
+            return self._change(instance_id, None, values)
+        key = {'kind': {'S': 'instance'}, 'key': {'S': instance_id}}
+        item = self.client.get_item(TableName=self.table, Key=key, ConsistentRead=True).get('Item')
+        if item is None:
+            return False
+        return self._change(instance_id, {dimension: value['S'] for dimension, value in item['values']['M'].items()}, None)
+
+    def counts(self):
+        counts = {}
+        for item in self._query('counter'):
+            counts.setdefault(item['dimension']['S'], Counter())[item['value']['S']] = int(item['count']['N'])
+        return counts
+
+    def claim(self, name, now, interval):
+        # Only one concurrent invocation wins the conditional update
+        try:
+            self.client.update_item(
+                TableName=self.table,
+                Key={'kind': {'S': 'meta'}, 'key': {'S': name}},
+                UpdateExpression='SET claimed = :now',
+                ConditionExpression='attribute_not_exists(claimed) OR claimed <= :due',
+                ExpressionAttributeValues={':now': {'N': str(int(now))}, ':due': {'N': str(int(now - interval))}},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def claim_reconcile(self, now, interval):
+        return self.claim('reconcile', now, interval)
+
+    def _stored_instances(self):
+        return {item['key']['S']: {dimension: value['S'] for dimension, value in item['values']['M'].items()}
+                for item in self._query('instance')}
+
+    def _set_counter(self, dimension, value, count, read):
+        # Conditioned on the count read, a counter an event changed since is left as is
+        key = {'kind': {'S': 'counter'}, 'key': {'S': '{}#{}'.format(dimension, value)}}
+        names = {'#count': 'count'}
+        if read is None:
+            condition, values = 'attribute_not_exists(#count)', {}
+        else:
+            condition, values = '#count = :read', {':read': {'N': str(read)}}
+        try:
+            if count:
+                self.client.update_item(
+                    TableName=self.table, Key=key,
+                    UpdateExpression='SET #dimension = :dimension, #value = :value, #count = :count',
+                    ConditionExpression=condition,
+                    ExpressionAttributeNames=dict(names, **{'#dimension': 'dimension', '#value': 'value'}),
+                    ExpressionAttributeValues=dict(values, **{
+                        ':dimension': {'S': dimension}, ':value': {'S': value}, ':count': {'N': str(count)}}),
+                )
+            else:
+                self.client.delete_item(TableName=self.table, Key=key, ConditionExpression=condition,
+                                        ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    def replace(self, instances):
+        # Instance items move to the scan through the same conditional transactions as
+        # apply, an instance an event changed since the read keeps the event's state
+        stored = self._stored_instances()
+        for instance_id in instances.keys() | stored.keys():
+            if stored.get(instance_id) != instances.get(instance_id):
+                self._change(instance_id, stored.get(instance_id), instances.get(instance_id))
+
+        # Counters that drifted from the instance items are corrected. They are read
+        # before the instances, so an event in between fails the counter's condition
+        stored_counts = {(item['dimension']['S'], item['value']['S']): int(item['count']['N'])
+                         for item in self._query('counter')}
+        counts = {(dimension, value): count
+                  for dimension, values in count_values(self._stored_instances()).items()
+                  for value, count in values.items()}
+        for dimension, value in counts.keys() | stored_counts.keys():
+            count, read = counts.get((dimension, value), 0), stored_counts.get((dimension, value))
+            # Counters down to zero are deleted
+            if (count or None) != read:
+                self._set_counter(dimension, value, count, read)
+
+
+def instance_values(values):
+    return {'M': {dimension: {'S': value} for dimension, value in values.items()}}
+
+
+def open_counter_store(uri):
+    # dynamodb://table, file://path only outside Lambda where every container
+    # would keep its own copy of the file
+    if uri.startswith('dynamodb://'):
+        return DynamoCounterStore(uri[len('dynamodb://'):])
+    if uri.startswith('file://'):
+        if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+            raise ValueError("COUNTER_STORE_URI {} is local to one Lambda container, use dynamodb://table".format(uri))
+        return LocalCounterStore(uri[len('file://'):])
+    raise ValueError("COUNTER_STORE_URI must be dynamodb://table, or file://path for local runs, got {!r}".format(uri))
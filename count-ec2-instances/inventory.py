@@ -0,0 +1,144 @@
+import re
+import json
+from collections import Counter
+from datetime import timezone
+from urllib.parse import unquote_plus
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# Inventory runs are written under <prefix>/<YYYY-MM-DDTHH-MMZ>/manifest.json
+RUN_FOLDER = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$')
+BATCH_SIZE = 64 * 1024
+# Inclusive upper bounds of the size histogram buckets, larger objects go to the final bucket
+SIZE_BUCKETS = [
+    ('1KB', 1024),
+    ('1MB', 1024 ** 2),
+    ('16MB', 16 * 1024 ** 2),
+    ('128MB', 128 * 1024 ** 2),
+    ('1GB', 1024 ** 3),
+]
+SIZE_BUCKET_LABELS = [label for label, _ in SIZE_BUCKETS] + ['larger']
+SIZE_BUCKET_BOUNDS = [bound for _, bound in SIZE_BUCKETS]
+
+
+class InventoryStats:
+    def __init__(self, run):
+        self.run = run
+        self.objects = 0
+        self.bytes = 0
+        self.newest = None
+        self.prefix_objects = Counter()
+        self.prefix_bytes = Counter()
+        self.histogram = {}
+
+    def age(self, now):
+        if self.newest is None:
+            return None
+        return (now - self.newest).total_seconds()
+
+
+def latest_manifest(s3_client, bucket, prefix):
+    # One delimited listing of the run folders instead of probing one date at a time
+    paginator = s3_client.get_paginator('list_objects_v2')
+    runs = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix.rstrip('/') + '/', Delimiter='/'):
+        runs += [common['Prefix'] for common in page.get('CommonPrefixes', []) if RUN_FOLDER.search(common['Prefix'])]
+    for run in sorted(runs, reverse=True):
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=run + 'manifest.json')
+        except s3_client.exceptions.NoSuchKey:
+            # The newest run may still be in progress
+            continue
+        return run, json.loads(response['Body'].read())
+    return None, None
+
+
+def _normalize(name):
+    return name.strip().replace('_', '').lower()
+
+
+def _columns(names):
+    # CSV headers are Key/Size/LastModifiedDate, Parquet uses key/size/last_modified_date
+    wanted = {'key': None, 'size': None, 'lastmodifieddate': None}
+    for name in names:
+        if _normalize(name) in wanted:
+            wanted[_normalize(name)] = name
+    return wanted['key'], wanted['size'], wanted['lastmodifieddate']
+
+
+def _csv_batches(filesystem, path, schema, batch_size):
+    names = [name.strip() for name in schema.split(',')]
+    key, size, last_modified = _columns(names)
+    stream = filesystem.open_input_stream(path, compression='gzip')
+    reader = pacsv.open_csv(
+        stream,
+        read_options=pacsv.ReadOptions(column_names=names, block_size=batch_size * 64),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[key, size, last_modified],
+            column_types={key: pa.string(), size: pa.int64(), last_modified: pa.timestamp('ms', 'UTC')},
+        ),
+    )
+    for batch in reader:
+        yield batch.column(key), batch.column(size), batch.column(last_modified)
+
+
+def _parquet_batches(filesystem, path, batch_size):
+    with filesystem.open_input_file(path) as source:
+        parquet_file = pq.ParquetFile(source)
+        key, size, last_modified = _columns(parquet_file.schema_arrow.names)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=[key, size, last_modified]):
+            yield batch.column(key), batch.column(size), batch.column(last_modified)
+
+
+def _top_prefixes(keys, url_encoded):
+    # First path segment of every key, '' for objects at the bucket root
+    separator = r'(/|%2[Ff]).*$' if url_encoded else r'/.*$'
+    prefixes = pc.replace_substring_regex(keys, separator, '')
+    return pc.if_else(pc.equal(prefixes, keys), '', prefixes)
+
+
+def analyze_inventory(manifest, run, filesystem=None, region=None, batch_size=BATCH_SIZE):
+    """Streams the data files of an inventory manifest batch by batch.
+
+    Only the key, size and last modified columns are read, so memory is bound
+    by the batch size and the number of top level prefixes, not by the size
+    of the inventory.
+    """
+    file_format = manifest['fileFormat'].upper()
+    if file_format not in ('CSV', 'PARQUET'):
+        raise ValueError('Unsupported inventory format {}'.format(manifest['fileFormat']))
+    filesystem = filesystem or pafs.S3FileSystem(region=region)
+    bucket = manifest['destinationBucket'].split(':::')[-1]
+    stats = InventoryStats(run)
+
+    for data_file in manifest['files']:
+        path = '{}/{}'.format(bucket, data_file['key'])
+        if file_format == 'CSV':
+            batches = _csv_batches(filesystem, path, manifest['fileSchema'], batch_size)
+        else:
+            batches = _parquet_batches(filesystem, path, batch_size)
+        for keys, sizes, last_modified in batches:
+            sizes = pc.fill_null(sizes, 0)
+            stats.objects += len(keys)
+            stats.bytes += pc.sum(sizes).as_py() or 0
+            newest = pc.max(last_modified).as_py()
+            if newest is not None:
+                newest = newest if newest.tzinfo else newest.replace(tzinfo=timezone.utc)
+                stats.newest = newest if stats.newest is None else max(stats.newest, newest)
+
+            table = pa.table({
+                'prefix': _top_prefixes(keys, file_format == 'CSV'),
+                'bucket': np.searchsorted(SIZE_BUCKET_BOUNDS, sizes.to_numpy(zero_copy_only=False)).astype(np.int8),
+                'size': sizes,
+            })
+            for row in table.group_by(['prefix', 'bucket']).aggregate([('size', 'count'), ('size', 'sum')]).to_pylist():
+                prefix = unquote_plus(row['prefix']) if file_format == 'CSV' else row['prefix']
+                stats.prefix_objects[prefix] += row['size_count']
+                stats.prefix_bytes[prefix] += row['size_sum']
+                stats.histogram.setdefault(prefix, Counter())[SIZE_BUCKET_LABELS[row['bucket']]] += row['size_count']
+    return stats
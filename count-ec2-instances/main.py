@@ -1,115 +1,193 @@
-import json
-import boto3
-from datetime import datetime, timezone, timedelta
+import os
+import time
+from functools import partial
+from collections import Counter
+from datetime import datetime, timezone
+from metrics import create_emitter
+from counters import open_counter_store
+from orphans import scan_orphans, OrphanCount
+from accounts import list_accounts, fan_out
+from clients import get_client
+from botocore.exceptions import ClientError
 
 running_instances_metric_name = 'NumberRunningInstances'
 running_spot_instances_metric_name = 'NumberRunningSpotInstances'
 data_upload_age = 'DataUploadAge'
+inventory_objects_metric_name = 'InventoryObjectCount'
+inventory_size_metric_name = 'InventoryTotalSize'
 orphan_eips_metric_name = 'NumberOrphanElasticIps'
+orphan_resources_metric_name = 'NumberOrphanResources'
+orphan_storage_metric_name = 'OrphanWastedStorage'
+orphan_cost_metric_name = 'OrphanMonthlyCost'
 ec2_metric_namespace = 'XPOZ/EC2'
 s3_metric_namespace = 'XPOZ/S3'
 bucket_name = 'mixer.inventory'
 folder_prefix = 'AVIT/mixer.dataupload/AVIT_Inventory'
+instance_dimensions = ['InstanceLifecycle', 'InstanceType', 'AvailabilityZone']
+state_change_event = 'EC2 Instance State-change Notification'
+# 'emf' prints Embedded Metric Format logs, 'cloudwatch' calls PutMetricData
+metrics_backend = os.environ.get('METRICS_BACKEND', 'cloudwatch').lower()
+# dynamodb://table used by event_handler, file://path for local runs
+counter_store_uri = os.environ.get('COUNTER_STORE_URI', '')
+reconcile_minutes = int(os.environ.get('RECONCILE_MINUTES', '60'))
+# The orphan scan of lambda_handler runs at most once per this many minutes
+orphan_scan_minutes = int(os.environ.get('ORPHAN_SCAN_MINUTES', '1440'))
+# Own snapshots older than this that no own AMI uses are counted as orphans
+orphan_snapshot_days = int(os.environ.get('ORPHAN_SNAPSHOT_DAYS', '90'))
+# Comma-separated tag keys, running instances are also counted per value of each
+instance_tag_keys = [key.strip() for key in os.environ.get('INSTANCE_TAG_KEYS', '').split(',') if key.strip()]
+# InventoryStats of the newest analyzed run folder, a warm container only reads the files of a new run
+inventory_cache = {}
+# Last orphan scan of this container, used when no counter store is configured
+last_orphan_scan = 0
 
 def lambda_handler(event, context):
-    ec2 = boto3.resource('ec2', region_name='eu-central-1')
-    s3_client = boto3.client('s3', region_name='eu-central-1')
-    cloudwatch = boto3.client('cloudwatch')
+    s3_client = get_client('s3', 'eu-central-1')
+    emitter = create_emitter(metrics_backend, lambda: get_client('cloudwatch'))
 
     timestamp = datetime.utcnow()
-    num_instances = count_instances(ec2)
-    spot_instances = count_spot_instances(ec2)
-    num_eips = count_orphin_eip(ec2)
-    dataupload_latest_file_age = check_latest_object_age(s3_client, bucket_name, folder_prefix)
+    # TARGET_ACCOUNTS fans the scans out to other accounts, their counts are
+    # published with an AccountId dimension and summed into the usual metrics
+    instance_counts = {dimension: Counter() for dimension in instance_dimensions + instance_tag_keys}
+    orphans = {}
+    failed = []
+    with_orphans = claim_orphan_scan(time.time())
+    for account_id, (result, error) in fan_out(partial(scan_account, with_orphans=with_orphans), list_accounts()).items():
+        if error:
+            print("Failed counting account %s: %s" % (account_id, error))
+            failed.append(account_id)
+            continue
+        account_counts, account_orphans = result
+        for dimension, counts in account_counts.items():
+            instance_counts[dimension].update(counts)
+        for resource_type, orphan in account_orphans.items():
+            orphans.setdefault(resource_type, OrphanCount()).update(orphan)
+        if account_id:
+            add_instance_metrics(emitter, timestamp, account_counts, {'AccountId': account_id})
+            add_orphan_metrics(emitter, timestamp, account_orphans, {'AccountId': account_id})
+    spot_instances = instance_counts['InstanceLifecycle']['spot']
+    num_instances = sum(instance_counts['InstanceLifecycle'].values()) - spot_instances
+    try:
+        inventory = inventory_stats(s3_client, bucket_name, folder_prefix)
+    except Exception as e:
+        # The instance and orphan metrics are published without the inventory
+        print("Failed analyzing the inventory: %s" % e)
+        inventory = None
     print("Observed %s instances running at %s" % (num_instances, timestamp))
     print("Observed %s spot instances running at %s" % (spot_instances, timestamp))
-    print("Observed %s orphaned elastic ips at %s" % (num_eips, timestamp))
-    print("Observed %s age of file in 'mixer.dataupload' bucket at %s" % (dataupload_latest_file_age, timestamp))
-    publish_metrics(cloudwatch, timestamp, num_instances, spot_instances, num_eips, dataupload_latest_file_age)
+    for resource_type, orphan in orphans.items():
+        print("Observed %s orphaned %s resources, %s GB, $%.2f a month at %s"
+              % (orphan.count, resource_type, orphan.gigabytes, orphan.monthly_cost, timestamp))
+    if inventory:
+        print("Observed %s age of file in 'mixer.dataupload' bucket at %s" % (inventory.age(datetime.now(timezone.utc)), timestamp))
+        print("Observed %s objects, %s bytes in 'mixer.dataupload' bucket at %s" % (inventory.objects, inventory.bytes, timestamp))
+    publish_metrics(emitter, timestamp, instance_counts, orphans, inventory)
+    if failed:
+        raise RuntimeError("Counting failed in accounts %s" % ", ".join(failed))
+
+
+def scan_account(account_id, session, with_orphans=True):
+    ec2_client = get_client('ec2', 'eu-central-1', account_id)
+    orphans = scan_orphans(ec2_client, orphan_snapshot_days) if with_orphans else {}
+    return scan_instances(ec2_client, instance_tag_keys), orphans
+
+
+# Orphans change slowly, the scan is claimed in the counter store so concurrent
+# containers share the ORPHAN_SCAN_MINUTES interval, or per container without one
+def claim_orphan_scan(now):
+    global last_orphan_scan
+    if counter_store_uri:
+        return open_counter_store(counter_store_uri).claim('orphan-scan', now, orphan_scan_minutes * 60)
+    if now - last_orphan_scan < orphan_scan_minutes * 60:
+        return False
+    last_orphan_scan = now
+    return True
     
 
-def count_spot_instances(ec2):
-    total_instances = 0
-    instances = ec2.instances.filter(Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': [
-                        'running',
-                    ]
-                },
-                {
-                    'Name': 'instance-lifecycle',
-                    'Values': [
-                        'spot',
-                    ]
-                },
-        ])
-    for _ in instances:
-        total_instances += 1
-    return total_instances
-
-def count_instances(ec2):
-    spot_instances = 0
-    total_instances = 0
-    instances = ec2.instances.filter(Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': [
-                        'running',
-                    ]
-                }
-            ])
-    for _ in instances:
-        if _.instance_lifecycle == 'spot':
-            spot_instances += 1
-        else:
-            total_instances += 1
-    return total_instances
-
-def check_latest_object_age(s3_client, bucket_name, folder_prefix):
-    today = datetime.now(timezone.utc)
-    date_str = today.strftime('%Y-%m-%dT01-00Z')
-    days_back = 1
-    inve_files = {}
-    total_size = 0
-
-    success = False
-    while not success:
-        try:
-            print("Now trying: {}".format(date_str))
-            inventory = s3_client.get_object(Bucket=bucket_name, Key="{}/{}/manifest.json".format(folder_prefix, date_str))
-            json_file = inventory['Body'].read().decode('utf-8')
-            data = json.loads(json_file)
-            for inventory_file in data['files']:
-                inve_files[inventory_file['key']] = inventory_file['size']
-                total_size += inventory_file['size']
-                # print(inventory_file['Key'])
-            # print(len(data['files']))
-            # new_date = today - timedelta(days=days_back)
-            # date_str = new_date.strftime('%Y-%m-%dT01-00Z')
-            # days_back += 1
-            # print("Total size of files: {}".format(total_size))
-            success = True  # If the function succeeds, set success to True to exit the loop
-        except Exception as e:
-            print("Failed finding files for: {}".format(date_str))
-            new_date = today - timedelta(days=days_back)
-            date_str = new_date.strftime('%Y-%m-%dT01-00Z')
-            days_back += 1
-    print("Inventory content:")
-    print(json.dumps(inve_files, indent=4))
-    # print(inve_files)
-    # age = today - inventory['LastModified']
-    # age_hours = age.total_seconds()
-    # return age_hours
-    return total_size
-
-# Counts the number of unattached elastic ip's
-def count_orphin_eip(ec2):
-    total_eips = 0
-    for eip in ec2.vpc_addresses.all():
-        if not eip.association:
-            total_eips += 1
-    return total_eips
+# Alternate handler for EC2 state-change events and a slow schedule: counters are
+# updated per event and the full scan only runs every RECONCILE_MINUTES
+def event_handler(event, context):
+    ec2_client = get_client('ec2', 'eu-central-1')
+    store = open_counter_store(counter_store_uri)
+    emitter = create_emitter(metrics_backend, lambda: get_client('cloudwatch'))
+
+    timestamp = datetime.utcnow()
+    if event.get('detail-type') == state_change_event:
+        instance_id = event['detail']['instance-id']
+        # The current state is described instead of trusting the event, so
+        # duplicated or out of order events settle on the right value
+        changed = store.apply(instance_id, describe_running_instance(ec2_client, instance_id, instance_tag_keys))
+        print("Instance %s is %s, counters %s" % (instance_id, event['detail']['state'], 'updated' if changed else 'unchanged'))
+    if store.claim_reconcile(time.time(), reconcile_minutes * 60):
+        print("Reconciling counters with a full scan at %s" % timestamp)
+        store.replace(dict(iter_running_instances(ec2_client, instance_tag_keys)))
+    instance_counts = store.counts()
+    for dimension in instance_dimensions + instance_tag_keys:
+        instance_counts.setdefault(dimension, Counter())
+    add_instance_metrics(emitter, timestamp, instance_counts)
+    emitter.flush()
+
+
+def instance_dimension_values(instance, tag_keys):
+    values = {
+        'InstanceLifecycle': 'spot' if instance.get('InstanceLifecycle') == 'spot' else 'on-demand',
+        'InstanceType': instance['InstanceType'],
+        'AvailabilityZone': instance['Placement']['AvailabilityZone'],
+    }
+    if tag_keys:
+        tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+        for key in tag_keys:
+            values[key] = tags.get(key, 'untagged')
+    return values
+
+# Yields (instance id, dimension values) for every running instance
+def iter_running_instances(ec2_client, tag_keys):
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(
+        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}],
+        PaginationConfig={'PageSize': 1000},
+    )
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                yield instance['InstanceId'], instance_dimension_values(instance, tag_keys)
+
+# Dimension values of the instance if it is running, None otherwise
+def describe_running_instance(ec2_client, instance_id, tag_keys):
+    try:
+        response = ec2_client.describe_instances(InstanceIds=[instance_id])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            return None
+        raise
+    for reservation in response['Reservations']:
+        for instance in reservation['Instances']:
+            if instance['State']['Name'] == 'running':
+                return instance_dimension_values(instance, tag_keys)
+    return None
+
+# Counts running instances per lifecycle, type, AZ and tag value in one paginated scan
+def scan_instances(ec2_client, tag_keys):
+    counts = {dimension: Counter() for dimension in instance_dimensions + tag_keys}
+    for _, values in iter_running_instances(ec2_client, tag_keys):
+        for dimension, value in values.items():
+            counts[dimension][value] += 1
+    return counts
+
+# Newest inventory of the data upload bucket streamed into InventoryStats, None without a manifest
+def inventory_stats(s3_client, bucket_name, folder_prefix):
+    # pyarrow is only imported by the code path that reads the inventory
+    from inventory import latest_manifest, analyze_inventory
+    run, manifest = latest_manifest(s3_client, bucket_name, folder_prefix)
+    if manifest is None:
+        print("No inventory manifest found under s3://{}/{}".format(bucket_name, folder_prefix))
+        return None
+    if run not in inventory_cache:
+        print("Analyzing inventory {}".format(run))
+        stats = analyze_inventory(manifest, run, region=s3_client.meta.region_name)
+        inventory_cache.clear()
+        inventory_cache[run] = stats
+    return inventory_cache[run]
 
 # def spot_usage():
 #     # Initialize the Cost Explorer client
@@ -146,53 +224,43 @@ def count_orphin_eip(ec2):
 #             cost = group['Metrics']['UnblendedCost']['Amount']
 #             print(f"From {start} to {end}, Spot Instance usage: {amount} hours, Cost: ${cost}")
 
-def publish_metrics(cloudwatch, timestamp, num_instances, spot_instances, num_eips, dataupload_latest_file_age):
-    cloudwatch.put_metric_data(
-        Namespace=ec2_metric_namespace,
-        MetricData=[
-            {
-                'MetricName': running_instances_metric_name,
-                'Dimensions': [
-                    {
-                        'Name': 'InstanceLifecycle',
-                        'Value': 'on-demand'
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': num_instances,
-                'Unit': 'Count',
-            },
-            {
-                'MetricName': running_instances_metric_name,
-                'Dimensions': [
-                    {
-                        'Name': 'InstanceLifecycle',
-                        'Value': 'spot'
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': spot_instances,
-                'Unit': 'Count',
-            },
-        ]
-    )
-    cloudwatch.put_metric_data(
-        Namespace=s3_metric_namespace,
-        MetricData=[
-                        {
-                'MetricName': data_upload_age,
-                'Dimensions': [
-                    {
-                        'Name': 'path',
-                        'Value': '{}/{}'.format(bucket_name, folder_prefix)
-                    }
-                ],
-                'Timestamp': timestamp,
-                'Value': dataupload_latest_file_age,
-                'Unit': 'Seconds',
-            },
-        ]
-    )
+def add_instance_metrics(emitter, timestamp, instance_counts, extra_dimensions=None):
+    # on-demand and spot are always published, even when no instance is running
+    lifecycles = Counter({'on-demand': 0, 'spot': 0})
+    lifecycles.update(instance_counts['InstanceLifecycle'])
+    for dimension, counts in instance_counts.items():
+        for value, count in (lifecycles if dimension == 'InstanceLifecycle' else counts).items():
+            emitter.add(ec2_metric_namespace, running_instances_metric_name, count, 'Count', timestamp,
+                        dict(extra_dimensions or {}, **{dimension: value}))
+
+def add_orphan_metrics(emitter, timestamp, orphans, extra_dimensions=None):
+    if 'ElasticIp' in orphans:
+        emitter.add(ec2_metric_namespace, orphan_eips_metric_name, orphans['ElasticIp'].count, 'Count', timestamp,
+                    extra_dimensions)
+    for resource_type, orphan in orphans.items():
+        dimensions = dict(extra_dimensions or {}, ResourceType=resource_type)
+        emitter.add(ec2_metric_namespace, orphan_resources_metric_name, orphan.count, 'Count', timestamp, dimensions)
+        emitter.add(ec2_metric_namespace, orphan_storage_metric_name, orphan.gigabytes, 'Gigabytes', timestamp, dimensions)
+        emitter.add(ec2_metric_namespace, orphan_cost_metric_name, orphan.monthly_cost, 'None', timestamp, dimensions)
+
+def publish_metrics(emitter, timestamp, instance_counts, orphans, inventory):
+    add_instance_metrics(emitter, timestamp, instance_counts)
+    add_orphan_metrics(emitter, timestamp, orphans)
+    if inventory:
+        path = '{}/{}'.format(bucket_name, folder_prefix)
+        age = inventory.age(datetime.now(timezone.utc))
+        if age is not None:
+            emitter.add(s3_metric_namespace, data_upload_age, age, 'Seconds', timestamp, {'path': path})
+        emitter.add(s3_metric_namespace, inventory_objects_metric_name, inventory.objects, 'Count', timestamp, {'path': path})
+        emitter.add(s3_metric_namespace, inventory_size_metric_name, inventory.bytes, 'Bytes', timestamp, {'path': path})
+        for prefix, objects in inventory.prefix_objects.items():
+            dimensions = {'path': path, 'Prefix': prefix or '/'}
+            emitter.add(s3_metric_namespace, inventory_objects_metric_name, objects, 'Count', timestamp, dimensions)
+            emitter.add(s3_metric_namespace, inventory_size_metric_name, inventory.prefix_bytes[prefix], 'Bytes', timestamp, dimensions)
+            for size_bucket, count in inventory.histogram[prefix].items():
+                emitter.add(s3_metric_namespace, inventory_objects_metric_name, count, 'Count', timestamp,
+                            dict(dimensions, SizeBucket=size_bucket))
+    emitter.flush()
 
 if __name__ == '__main__':
     # spot_usage()
@@ -0,0 +1,88 @@
+import json
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import timezone
+
+# PutMetricData accepts up to 1000 metrics per request, EMF up to 100 per document
+max_put_metric_data = 1000
+max_emf_metrics = 100
+
+
+class MetricsEmitter(ABC):
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def add(self, namespace, name, value, unit, timestamp, dimensions=None):
+        self.metrics.setdefault(namespace, []).append({
+            'MetricName': name,
+            'Dimensions': [{'Name': key, 'Value': str(dimension_value)} for key, dimension_value in (dimensions or {}).items()],
+            'Timestamp': timestamp,
+            'Value': value,
+            'Unit': unit,
+        })
+
+    @abstractmethod
+    def flush(self):
+        pass
+
+
+class PutMetricDataEmitter(MetricsEmitter):
+    """Sends the collected metrics with as few PutMetricData calls as the API allows."""
+
+    def __init__(self, cloudwatch):
+        super().__init__()
+        self.cloudwatch = cloudwatch
+
+    def flush(self):
+        for namespace, metric_data in self.metrics.items():
+            for index in range(0, len(metric_data), max_put_metric_data):
+                self.cloudwatch.put_metric_data(Namespace=namespace, MetricData=metric_data[index:index + max_put_metric_data])
+        self.metrics.clear()
+
+
+class EmfEmitter(MetricsEmitter):
+    """Prints the metrics in CloudWatch Embedded Metric Format.
+
+    The Lambda log stream turns every printed document into metrics, so no
+    CloudWatch API call is made. Metrics sharing namespace, timestamp and
+    dimension values go into the same document.
+    """
+
+    def __init__(self, output=print):
+        super().__init__()
+        self.output = output
+
+    def flush(self):
+        documents = OrderedDict()
+        for namespace, metric_data in self.metrics.items():
+            for metric in metric_data:
+                dimensions = tuple((dimension['Name'], dimension['Value']) for dimension in metric['Dimensions'])
+                documents.setdefault((namespace, metric['Timestamp'], dimensions), []).append(metric)
+        for (namespace, timestamp, dimensions), metric_data in documents.items():
+            for index in range(0, len(metric_data), max_emf_metrics):
+                self.output(json.dumps(emf_document(namespace, timestamp, dimensions, metric_data[index:index + max_emf_metrics])))
+        self.metrics.clear()
+
+
+def emf_document(namespace, timestamp, dimensions, metric_data):
+    document = {
+        '_aws': {
+            'Timestamp': int(timestamp.replace(tzinfo=timestamp.tzinfo or timezone.utc).timestamp() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [[name for name, _ in dimensions]],
+                'Metrics': [{'Name': metric['MetricName'], 'Unit': metric['Unit']} for metric in metric_data],
+            }],
+        },
+    }
+    document.update(dimensions)
+    for metric in metric_data:
+        document[metric['MetricName']] = metric['Value']
+    return document
+
+
+def create_emitter(backend, cloudwatch_factory):
+    # emf needs no client, the factory is only called for the PutMetricData backend
+    if backend == 'emf':
+        return EmfEmitter()
+    return PutMetricDataEmitter(cloudwatch_factory())
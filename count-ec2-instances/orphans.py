@@ -0,0 +1,116 @@
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 1000
+# eu-central-1 on-demand prices in USD, EBS per GB-month, public IPv4 per hour
+VOLUME_GB_MONTH = {
+    'gp2': 0.119,
+    'gp3': 0.0952,
+    'io1': 0.149,
+    'io2': 0.149,
+    'st1': 0.054,
+    'sc1': 0.0179,
+    'standard': 0.058,
+}
+SNAPSHOT_GB_MONTH = 0.054
+PUBLIC_IPV4_HOUR = 0.005
+HOURS_PER_MONTH = 730
+
+
+class OrphanCount:
+    __slots__ = ('count', 'gigabytes', 'monthly_cost')
+
+    def __init__(self, count=0, gigabytes=0, monthly_cost=0.0):
+        self.count = count
+        self.gigabytes = gigabytes
+        self.monthly_cost = monthly_cost
+
+    def add(self, gigabytes=0, monthly_cost=0.0):
+        self.count += 1
+        self.gigabytes += gigabytes
+        self.monthly_cost += monthly_cost
+
+    def update(self, other):
+        self.count += other.count
+        self.gigabytes += other.gigabytes
+        self.monthly_cost += other.monthly_cost
+
+
+def _paginate(ec2_client, operation, key, **kwargs):
+    paginator = ec2_client.get_paginator(operation)
+    for page in paginator.paginate(PaginationConfig={'PageSize': PAGE_SIZE}, **kwargs):
+        yield from page[key]
+
+
+def unassociated_addresses(ec2_client, snapshot_days):
+    # describe_addresses has no paginator, it returns every address at once
+    result = OrphanCount()
+    for address in ec2_client.describe_addresses()['Addresses']:
+        if not address.get('AssociationId'):
+            result.add(monthly_cost=PUBLIC_IPV4_HOUR * HOURS_PER_MONTH)
+    return result
+
+
+def available_volumes(ec2_client, snapshot_days):
+    result = OrphanCount()
+    for volume in _paginate(ec2_client, 'describe_volumes', 'Volumes',
+                            Filters=[{'Name': 'status', 'Values': ['available']}]):
+        result.add(volume['Size'], volume['Size'] * VOLUME_GB_MONTH.get(volume['VolumeType'], 0.0))
+    return result
+
+
+def available_network_interfaces(ec2_client, snapshot_days):
+    result = OrphanCount()
+    for _ in _paginate(ec2_client, 'describe_network_interfaces', 'NetworkInterfaces',
+                       Filters=[{'Name': 'status', 'Values': ['available']}]):
+        result.add()
+    return result
+
+
+def unused_security_groups(ec2_client, snapshot_days):
+    # Groups attached to no network interface, default groups cannot be deleted and are skipped
+    in_use = set()
+    for interface in _paginate(ec2_client, 'describe_network_interfaces', 'NetworkInterfaces'):
+        in_use.update(group['GroupId'] for group in interface['Groups'])
+    result = OrphanCount()
+    for group in _paginate(ec2_client, 'describe_security_groups', 'SecurityGroups'):
+        if group['GroupName'] != 'default' and group['GroupId'] not in in_use:
+            result.add()
+    return result
+
+
+def stale_snapshots(ec2_client, snapshot_days):
+    # Own snapshots older than snapshot_days that no own AMI refers to
+    images = _paginate(ec2_client, 'describe_images', 'Images', Owners=['self'])
+    in_use = {mapping['Ebs']['SnapshotId'] for image in images for mapping in image.get('BlockDeviceMappings', [])
+              if mapping.get('Ebs', {}).get('SnapshotId')}
+    cutoff = datetime.now(timezone.utc) - timedelta(days=snapshot_days)
+    result = OrphanCount()
+    for snapshot in _paginate(ec2_client, 'describe_snapshots', 'Snapshots', OwnerIds=['self'],
+                              Filters=[{'Name': 'status', 'Values': ['completed']}]):
+        if snapshot['StartTime'] < cutoff and snapshot['SnapshotId'] not in in_use:
+            result.add(snapshot['VolumeSize'], snapshot['VolumeSize'] * SNAPSHOT_GB_MONTH)
+    return result
+
+
+ORPHAN_CHECKS = {
+    'ElasticIp': unassociated_addresses,
+    'Volume': available_volumes,
+    'NetworkInterface': available_network_interfaces,
+    'SecurityGroup': unused_security_groups,
+    'Snapshot': stale_snapshots,
+}
+
+
+def scan_orphans(ec2_client, snapshot_days, checks=ORPHAN_CHECKS):
+    # Every resource type is checked on its own thread, a failing check is
+    # reported and left out instead of failing the others
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(checks)) as pool:
+        futures = {name: pool.submit(check, ec2_client, snapshot_days) for name, check in checks.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print("Failed checking orphaned {} resources: {}".format(name, e))
+    return results
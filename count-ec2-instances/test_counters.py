@@ -0,0 +1,196 @@
+"""Checks how the DynamoDB counter store handles cancelled transactions and
+events arriving during a reconcile.
+
+Runs without AWS access: python3 test_counters.py
+"""
+import os
+import sys
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from counters import DynamoCounterStore
+
+VALUES = {'InstanceType': 't3.micro', 'AvailabilityZone': 'eu-central-1a'}
+
+
+def cancelled(*codes):
+    return ClientError({
+        'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+        'CancellationReasons': [{'Code': code} for code in codes],
+    }, 'TransactWriteItems')
+
+
+class FakeDynamo:
+    # transact_write_items raises the given outcomes in order, then succeeds
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.transactions = []
+
+    def transact_write_items(self, TransactItems):
+        self.transactions.append(TransactItems)
+        if self.outcomes:
+            raise self.outcomes.pop(0)
+
+
+class MemoryDynamo:
+    """The table as a dict, evaluating only the conditions the counter store writes.
+
+    after_query(kind) runs once a query has read its items, to apply events mid-reconcile.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.after_query = None
+
+    def _check(self, key, request):
+        item = self.items.get(key)
+        condition = request.get('ConditionExpression')
+        values = request.get('ExpressionAttributeValues', {})
+        if condition is None:
+            return True
+        if condition.startswith('attribute_not_exists'):
+            return item is None
+        if condition == '#values = :old':
+            return item is not None and item['values'] == values[':old']
+        if condition == '#count = :read':
+            return item is not None and item['count'] == values[':read']
+        raise AssertionError(condition)
+
+    def _update(self, key, request):
+        values = request['ExpressionAttributeValues']
+        item = self.items.setdefault(key, {'kind': {'S': key[0]}, 'key': {'S': key[1]}})
+        item['dimension'], item['value'] = values[':dimension'], values[':value']
+        if ':delta' in values:
+            item['count'] = {'N': str(int(item.get('count', {'N': '0'})['N']) + int(values[':delta']['N']))}
+        else:
+            item['count'] = values[':count']
+
+    @staticmethod
+    def _key(key):
+        return key['kind']['S'], key['key']['S']
+
+    def transact_write_items(self, TransactItems):
+        checks = []
+        for entry in TransactItems:
+            (action, request), = entry.items()
+            key = self._key(request.get('Key') or request['Item'])
+            checks.append('None' if self._check(key, request) else 'ConditionalCheckFailed')
+        if 'ConditionalCheckFailed' in checks:
+            raise cancelled(*checks)
+        for entry in TransactItems:
+            (action, request), = entry.items()
+            key = self._key(request.get('Key') or request['Item'])
+            if action == 'Put':
+                self.items[key] = request['Item']
+            elif action == 'Delete':
+                self.items.pop(key, None)
+            else:
+                self._update(key, request)
+
+    def update_item(self, Key, **request):
+        if not self._check(self._key(Key), request):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        self._update(self._key(Key), request)
+
+    def delete_item(self, Key, **request):
+        if not self._check(self._key(Key), request):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'DeleteItem')
+        self.items.pop(self._key(Key), None)
+
+    def get_item(self, Key, **request):
+        item = self.items.get(self._key(Key))
+        return {'Item': item} if item else {}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, ExpressionAttributeValues, **request):
+        kind = ExpressionAttributeValues[':kind']['S']
+        items = [item for (item_kind, _), item in sorted(self.items.items()) if item_kind == kind]
+        if self.after_query:
+            self.after_query(kind)
+        return [{'Items': items}]
+
+
+def store(*outcomes):
+    counter_store = DynamoCounterStore('counters', FakeDynamo(*outcomes))
+    counter_store.base_delay = 0
+    return counter_store
+
+
+def test_apply_writes_the_instance_and_its_counters():
+    counter_store = store()
+    assert counter_store.apply('i-1', VALUES)
+    assert len(counter_store.client.transactions[0]) == 1 + len(VALUES)
+
+
+def test_failed_instance_condition_is_a_duplicate_event():
+    counter_store = store(cancelled('ConditionalCheckFailed', 'None', 'None'))
+    assert counter_store.apply('i-1', VALUES) is False
+    assert len(counter_store.client.transactions) == 1
+
+
+def test_conflicting_counter_update_is_retried():
+    counter_store = store(cancelled('None', 'TransactionConflict', 'None'), cancelled('None', 'None', 'TransactionConflict'))
+    assert counter_store.apply('i-1', VALUES)
+    assert len(counter_store.client.transactions) == 3
+
+
+def test_conflict_after_the_last_attempt_is_raised():
+    counter_store = store(*[cancelled('None', 'TransactionConflict', 'None')] * DynamoCounterStore.max_attempts)
+    try:
+        counter_store.apply('i-1', VALUES)
+    except ClientError:
+        pass
+    else:
+        raise AssertionError('the conflict was not raised')
+    assert len(counter_store.client.transactions) == DynamoCounterStore.max_attempts
+
+
+def test_other_cancellation_reasons_are_raised():
+    counter_store = store(cancelled('None', 'ProvisionedThroughputExceeded', 'None'))
+    try:
+        counter_store.apply('i-1', VALUES)
+    except ClientError:
+        pass
+    else:
+        raise AssertionError('the cancellation was not raised')
+    assert len(counter_store.client.transactions) == 1
+
+
+def test_replace_fixes_instances_and_drifted_counters():
+    counter_store = DynamoCounterStore('counters', MemoryDynamo())
+    counter_store.apply('i-1', VALUES)
+    counter_store.apply('i-2', dict(VALUES, InstanceType='m5.large'))
+    counter_store._set_counter('InstanceType', 't3.micro', 5, 1)
+    counter_store.replace({'i-1': VALUES, 'i-3': VALUES})
+    assert counter_store._stored_instances() == {'i-1': VALUES, 'i-3': VALUES}
+    assert counter_store.counts() == {'InstanceType': {'t3.micro': 2}, 'AvailabilityZone': {'eu-central-1a': 2}}
+
+
+def test_replace_keeps_events_applied_during_it():
+    memory = MemoryDynamo()
+    counter_store = DynamoCounterStore('counters', memory)
+    counter_store.apply('i-1', VALUES)
+    counter_store.apply('i-2', VALUES)
+
+    def event(kind):
+        # i-2 terminates and i-4 launches after the reconcile read the instances
+        if kind == 'instance':
+            memory.after_query = None
+            counter_store.apply('i-2', None)
+            counter_store.apply('i-4', VALUES)
+    memory.after_query = event
+    # The scan saw i-2 gone and i-3 running, it ran before i-4 launched
+    counter_store.replace({'i-1': VALUES, 'i-3': VALUES})
+    assert sorted(counter_store._stored_instances()) == ['i-1', 'i-3', 'i-4']
+    assert counter_store.counts()['InstanceType'] == {'t3.micro': 3}
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('ok', name)
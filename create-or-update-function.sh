@@ -3,6 +3,7 @@ set -e
 
 REGION=${REGION:-us-east-1}
 PYTHON_VERSION=${PYTHON_VERSION:-python3.11}
+DEPLOY_BUCKET=${DEPLOY_BUCKET:-}
 FUNCTION_NAME=$1
 FREQ=$2
 
@@ -20,13 +21,27 @@ fi
 aws iam put-role-policy --region $REGION --role-name "${FUNCTION_NAME}LambdaRole" \
     --policy-name "${FUNCTION_NAME}Policy" --policy-document file://lambda-role-policy.json
 
+# Lambda only takes zips over 50 MB from S3
+if [ -n "$DEPLOY_BUCKET" ]; then
+    CODE_KEY="${FUNCTION_NAME}/deployment-package.zip"
+    aws s3 cp --region $REGION deployment-package.zip "s3://${DEPLOY_BUCKET}/${CODE_KEY}"
+    CREATE_CODE="--code S3Bucket=${DEPLOY_BUCKET},S3Key=${CODE_KEY}"
+    UPDATE_CODE="--s3-bucket ${DEPLOY_BUCKET} --s3-key ${CODE_KEY}"
+elif [ $(wc -c < deployment-package.zip) -gt 52428800 ]; then
+    echo "deployment-package.zip is over 50 MB, set DEPLOY_BUCKET to upload it through S3"
+    exit 1
+else
+    CREATE_CODE="--zip-file fileb://deployment-package.zip"
+    UPDATE_CODE="--zip-file fileb://deployment-package.zip"
+fi
+
 if ! aws lambda get-function --region $REGION --function-name $FUNCTION_NAME &> /dev/null; then
     echo "Function does not exist, creating..."
     ROLE_ARN="arn:aws:iam::$ACCOUNT_ID:role/${FUNCTION_NAME}LambdaRole"
     aws lambda create-function \
         --region $REGION \
 	    --function-name $FUNCTION_NAME \
-	    --zip-file fileb://deployment-package.zip \
+	    $CREATE_CODE \
 	    --handler main.lambda_handler \
 	    --runtime $PYTHON_VERSION \
 	    --memory-size 512 \
@@ -37,7 +52,7 @@ else
     nohup aws lambda update-function-code \
         --region $REGION \
         --function-name $FUNCTION_NAME \
-        --zip-file fileb://deployment-package.zip &
+        $UPDATE_CODE &
     # aws lambda delete-function --region $REGION --function-name $FUNCTION_NAME || true
 	# aws lambda create-function \
     #     --region $REGION \
@@ -50,6 +65,10 @@ else
 	#     --role "$ROLE_ARN"
 fi
 
+# Layers built by package.py --layers are attached once the code update is done
+wait
+../publish-layers.sh $FUNCTION_NAME
+
 case $FREQ in
     "Daily")
         rules="cron(0 10 * * ? *)"
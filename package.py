@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Builds slim, precompiled Lambda deployment packages.
+
+For every function directory (main.py + requirements.txt) the requirements are
+installed for the Lambda runtime, tests, docs, type stubs, C sources and the
+botocore models of services the code never calls are pruned, the code is
+compiled to .pyc and everything is zipped to build/<function>/function.zip.
+With --layers the heavy dependencies go to shared layer zips instead, listed
+in build/<function>/layers.txt for publish-layers.sh. The
+package sizes and the measured `import main` time of every function are printed
+and written to build/report.json.
+
+    python3 package.py [function ...] [--layers] [--python-version 3.11]
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import zipfile
+import argparse
+import compileall
+import subprocess
+import py_compile
+import statistics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Layers shared by every function requiring one of their packages
+LAYERS = {
+    'data': ['numpy', 'pandas', 'pyarrow'],
+}
+# botocore.docs and boto3.docs are imported by the clients, so docs directories stay
+PRUNE_DIRS = {'tests', '__pycache__', 'examples', 'benchmarks'}
+PRUNE_SUFFIXES = ('.pyi', '.pyx', '.pxd', '.pxi', '.c', '.cc', '.cpp', '.h', '.hpp')
+# pyarrow ships its C++ headers and the Cython sources of its bindings
+PRUNE_PATHS = ['pyarrow/include', 'pyarrow/src', 'numpy/_core/include', 'numpy/core/include']
+# sts is used to assume roles, the rest are found in the sources
+ALWAYS_SERVICES = {'sts'}
+SERVICE_CALL = re.compile(r"""(?:get_client|\.client)\(\s*['"]([a-z0-9-]+)['"]""")
+LAMBDA_UNZIPPED_LIMIT = 250 * 1024 * 1024
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def find_functions():
+    return sorted(name for name in os.listdir(ROOT)
+                  if os.path.isfile(os.path.join(ROOT, name, 'main.py'))
+                  and os.path.isfile(os.path.join(ROOT, name, 'requirements.txt')))
+
+
+def read_requirements(function):
+    with open(os.path.join(ROOT, function, 'requirements.txt')) as requirements:
+        return [line.strip() for line in requirements if line.strip() and not line.startswith('#')]
+
+
+def requirement_name(requirement):
+    return re.split(r'[<>=!~\[; ]', requirement, 1)[0].lower().replace('_', '-')
+
+
+def used_services(function):
+    services = set(ALWAYS_SERVICES)
+    for path in source_files(function):
+        with open(path) as source:
+            services.update(SERVICE_CALL.findall(source.read()))
+    return services
+
+
+def source_files(function):
+    # Symlinked shared modules are followed and packaged as regular files, test scripts are left out
+    directory = os.path.join(ROOT, function)
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith('.py') and not name.startswith('test_'))
+
+
+def pip_install(requirements, target, args):
+    platform = 'manylinux2014_aarch64' if args.arch == 'arm64' else 'manylinux2014_x86_64'
+    subprocess.run([
+        sys.executable, '-m', 'pip', 'install', '--quiet', '--upgrade', '--no-compile',
+        '--target', target,
+        '--platform', platform,
+        '--implementation', 'cp',
+        '--python-version', args.python_version,
+        '--only-binary=:all:',
+    ] + requirements, check=True)
+
+
+def prune(target, services):
+    for path in PRUNE_PATHS:
+        shutil.rmtree(os.path.join(target, path), ignore_errors=True)
+    for directory, dirs, files in os.walk(target):
+        for name in [name for name in dirs if name in PRUNE_DIRS]:
+            shutil.rmtree(os.path.join(directory, name))
+            dirs.remove(name)
+        for name in files:
+            if name.endswith(PRUNE_SUFFIXES):
+                os.remove(os.path.join(directory, name))
+    # Service models are directories, the endpoint and retry files next to them are kept
+    for data in ('botocore/data', 'boto3/data'):
+        data = os.path.join(target, data)
+        if os.path.isdir(data):
+            for name in os.listdir(data):
+                if os.path.isdir(os.path.join(data, name)) and name not in services:
+                    shutil.rmtree(os.path.join(data, name))
+
+
+def precompile(target, args):
+    # A .pyc of another Python version is ignored by the runtime, so nothing is compiled
+    if '{}.{}'.format(*sys.version_info[:2]) != args.python_version:
+        print('  skipping .pyc, building with Python {}.{} for {}'.format(
+            sys.version_info[0], sys.version_info[1], args.python_version))
+        return
+    # Unchecked hashes skip the source mtime check on the read-only Lambda file system
+    compileall.compile_dir(target, quiet=1, workers=0,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def directory_size(target):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, files in os.walk(target) for name in files)
+
+
+def write_zip(target, output, prefix=''):
+    # Sorted entries and a fixed date give the same zip for the same content
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        for directory, dirs, files in os.walk(target):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                info = zipfile.ZipInfo(os.path.join(prefix, os.path.relpath(path, target)), ZIP_DATE)
+                info.external_attr = (0o755 if os.access(path, os.X_OK) else 0o644) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as source:
+                    archive.writestr(info, source.read())
+    return os.path.getsize(output)
+
+
+def build_layer(name, requirements, args):
+    layer_dir = os.path.join(args.build_dir, 'layers', name)
+    target = os.path.join(layer_dir, 'python')
+    shutil.rmtree(layer_dir, ignore_errors=True)
+    print('Building layer {}: {}'.format(name, ' '.join(requirements)))
+    pip_install(requirements, target, args)
+    prune(target, set())
+    precompile(target, args)
+    size = write_zip(target, os.path.join(layer_dir, 'layer.zip'), 'python')
+    return {'path': target, 'zip_bytes': size, 'unzipped_bytes': directory_size(target), 'requirements': requirements}
+
+
+def build_function(function, layers, args):
+    function_dir = os.path.join(args.build_dir, function)
+    target = os.path.join(function_dir, 'package')
+    shutil.rmtree(function_dir, ignore_errors=True)
+    os.makedirs(target)
+    requirements = read_requirements(function)
+    if not args.bundle_boto3:
+        requirements = [r for r in requirements if requirement_name(r) not in ('boto3', 'botocore')]
+    print('Building {}: {}'.format(function, ' '.join(requirements) or 'no requirements'))
+    if requirements:
+        pip_install(requirements, target, args)
+
+    # Anything a layer of this function already provides is dropped from the package
+    function_layers = [name for name, layer in layers.items()
+                       if {requirement_name(r) for r in layer['requirements']} & {requirement_name(r) for r in requirements}]
+    for name in function_layers:
+        for entry in os.listdir(layers[name]['path']):
+            path = os.path.join(target, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    services = used_services(function)
+    prune(target, services)
+    for path in source_files(function):
+        shutil.copyfile(path, os.path.join(target, os.path.basename(path)))
+    precompile(target, args)
+
+    size = write_zip(target, os.path.join(function_dir, 'function.zip'))
+    # Read by publish-layers.sh to attach the layers this package leaves out
+    with open(os.path.join(function_dir, 'layers.txt'), 'w') as layers_file:
+        layers_file.write(''.join(name + '\n' for name in function_layers))
+    unzipped = directory_size(target) + sum(layers[name]['unzipped_bytes'] for name in function_layers)
+    return {
+        'zip_bytes': size,
+        'unzipped_bytes': unzipped,
+        'layers': function_layers,
+        'services': sorted(services),
+        'import': measure_import(target, [layers[name]['path'] for name in function_layers], args),
+    }
+
+
+def measure_import(target, layer_paths, args):
+    # Every run is a fresh interpreter, like a cold start, importing main from the package only
+    if '{}.{}'.format(*sys.version_info[:2]) != args.python_version:
+        return None
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([target] + layer_paths), PYTHONDONTWRITEBYTECODE='1')
+    runs = []
+    slowest = []
+    for _ in range(args.import_runs):
+        result = subprocess.run([sys.executable, '-S', '-X', 'importtime', '-c', 'import main'],
+                                cwd=target, env=env, capture_output=True, text=True)
+        if result.returncode:
+            return {'error': result.stderr.strip().splitlines()[-1]}
+        # importtime lines are "import time: self [us] | cumulative | package", indented by depth
+        imported = []
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[0].startswith('import time:') and parts[1].strip().isdigit():
+                imported.append((int(parts[1]), parts[2].rstrip()))
+        # The main line follows the modules it imported, depth one are its direct imports
+        index = next(i for i, (_, name) in enumerate(imported) if name == ' main')
+        runs.append(imported[index][0])
+        start = max([i + 1 for i, (_, name) in enumerate(imported[:index]) if not name.startswith('  ')] or [0])
+        slowest = sorted((cumulative, name.strip()) for cumulative, name in imported[start:index]
+                         if name.startswith('   ') and not name.startswith('     '))[::-1][:5]
+    return {
+        'median_ms': round(statistics.median(runs) / 1000, 1),
+        'slowest': [{'module': name, 'ms': round(cumulative / 1000, 1)} for cumulative, name in slowest],
+    }
+
+
+def megabytes(size):
+    return '{:.1f} MB'.format(size / 1024 / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build slim, precompiled Lambda packages.')
+    parser.add_argument('functions', nargs='*', help='function directories (default: all)')
+    parser.add_argument('--python-version', default=os.environ.get('PYTHON_VERSION', '3.11').replace('python', ''))
+    parser.add_argument('--arch', choices=['x86_64', 'arm64'], default='x86_64')
+    parser.add_argument('--layers', action='store_true', help='move heavy dependencies to shared layers')
+    parser.add_argument('--no-boto3', dest='bundle_boto3', action='store_false',
+                        help='use the boto3 of the Lambda runtime instead of the pinned one')
+    parser.add_argument('--import-runs', type=int, default=3)
+    parser.add_argument('--build-dir', default=os.path.join(ROOT, 'build'))
+    args = parser.parse_args()
+
+    functions = [function.strip('/') for function in args.functions] or find_functions()
+    layers = {}
+    if args.layers:
+        requirements = {function: read_requirements(function) for function in functions}
+        for name, packages in LAYERS.items():
+            # The pinned versions the functions ask for, every function must agree on them
+            layer_requirements = sorted({r for function_requirements in requirements.values()
+                                         for r in function_requirements if requirement_name(r) in packages})
+            if layer_requirements:
+                layers[name] = build_layer(name, layer_requirements, args)
+
+    report = {'python_version': args.python_version, 'arch': args.arch, 'layers': {}, 'functions': {}}
+    for name, layer in layers.items():
+        report['layers'][name] = {key: value for key, value in layer.items() if key != 'path'}
+    for function in functions:
+        report['functions'][function] = build_function(function, layers, args)
+
+    print()
+    for name, layer in report['layers'].items():
+        print('layer {:<20} zip {:>10}  unzipped {:>10}'.format(
+            name, megabytes(layer['zip_bytes']), megabytes(layer['unzipped_bytes'])))
+    for function, result in report['functions'].items():
+        imported = result['import']
+        if imported is None:
+            timing = 'import not measured'
+        elif 'error' in imported:
+            timing = 'import failed: {}'.format(imported['error'])
+        else:
+            timing = 'import {} ms ({})'.format(imported['median_ms'], ', '.join(
+                '{} {} ms'.format(module['module'], module['ms']) for module in imported['slowest'][:3]))
+        print('{:<26} zip {:>10}  unzipped {:>10}  {}'.format(
+            function, megabytes(result['zip_bytes']), megabytes(result['unzipped_bytes']), timing))
+        if result['unzipped_bytes'] > LAMBDA_UNZIPPED_LIMIT:
+            print('  WARNING: {} is over the 250 MB unzipped Lambda limit, try --layers'.format(function))
+
+    with open(os.path.join(args.build_dir, 'report.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
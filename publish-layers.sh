@@ -0,0 +1,58 @@
+#!/bin/bash
+set -e
+
+# Publishes the layers `package.py --layers` built for a function and attaches them to it.
+# Run from the function directory: ../publish-layers.sh FUNCTION_NAME [BUILD_DIR]
+REGION=${REGION:-us-east-1}
+PYTHON_VERSION=${PYTHON_VERSION:-python3.11}
+RUNTIME="python${PYTHON_VERSION#python}"
+DEPLOY_BUCKET=${DEPLOY_BUCKET:-}
+LAYER_PREFIX=${LAYER_PREFIX:-lambdas}
+FUNCTION_NAME=$1
+BUILD_DIR=${2:-../build/$(basename "$PWD")}
+
+if [ ! -s "$BUILD_DIR/layers.txt" ]; then
+    echo "No layers to publish for $FUNCTION_NAME"
+    exit 0
+fi
+
+LAYER_ARNS=""
+for LAYER in $(cat "$BUILD_DIR/layers.txt"); do
+    LAYER_ZIP="$(dirname "$BUILD_DIR")/layers/$LAYER/layer.zip"
+    LAYER_NAME="${LAYER_PREFIX}-${LAYER}"
+    LAYER_SHA=$( (sha256sum "$LAYER_ZIP" 2> /dev/null || shasum -a 256 "$LAYER_ZIP") | awk '{print $1}')
+
+    # The layer zips are deterministic, an unchanged one reuses its published version
+    LAYER_ARN=$(aws lambda list-layer-versions --region $REGION --layer-name "$LAYER_NAME" \
+        --query "LayerVersions[?Description=='sha256:${LAYER_SHA}'] | [0].LayerVersionArn" --output text)
+    if [ -z "$LAYER_ARN" ] || [ "$LAYER_ARN" == "None" ]; then
+        if [ -n "$DEPLOY_BUCKET" ]; then
+            aws s3 cp --region $REGION "$LAYER_ZIP" "s3://${DEPLOY_BUCKET}/layers/${LAYER_NAME}.zip"
+            LAYER_CONTENT="S3Bucket=${DEPLOY_BUCKET},S3Key=layers/${LAYER_NAME}.zip"
+        elif [ $(wc -c < "$LAYER_ZIP") -gt 52428800 ]; then
+            echo "$LAYER_ZIP is over 50 MB, set DEPLOY_BUCKET to upload it through S3"
+            exit 1
+        else
+            LAYER_CONTENT="ZipFile=fileb://$LAYER_ZIP"
+        fi
+        echo "Publishing layer $LAYER_NAME..."
+        LAYER_ARN=$(aws lambda publish-layer-version \
+            --region $REGION \
+            --layer-name "$LAYER_NAME" \
+            --description "sha256:${LAYER_SHA}" \
+            --content "$LAYER_CONTENT" \
+            --compatible-runtimes $RUNTIME \
+            --query LayerVersionArn \
+            --output text)
+    fi
+    LAYER_ARNS="$LAYER_ARNS $LAYER_ARN"
+done
+
+# The configuration can only change once a create or code update has finished
+aws lambda wait function-active --region $REGION --function-name $FUNCTION_NAME
+aws lambda wait function-updated --region $REGION --function-name $FUNCTION_NAME
+echo "Attaching layers:$LAYER_ARNS"
+aws lambda update-function-configuration \
+    --region $REGION \
+    --function-name $FUNCTION_NAME \
+    --layers $LAYER_ARNS > /dev/null
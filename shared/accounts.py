@@ -0,0 +1,96 @@
+import os
+import threading
+
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+TARGET_ACCOUNTS = os.environ.get('TARGET_ACCOUNTS', '')
+TARGET_ROLE_NAME = os.environ.get('TARGET_ROLE_NAME', 'OrganizationAccountAccessRole')
+FAN_OUT_WORKERS = int(os.environ.get('FAN_OUT_WORKERS', '8'))
+# Assumed-role sessions are renewed this long before they expire, longer than
+# the 15 minute Lambda timeout so a session never expires during a run
+REFRESH_MARGIN = timedelta(minutes=20)
+
+# Module level so warm invocations reuse the assumed sessions
+_sessions = {}
+_own_account = []
+_lock = threading.Lock()
+_account_locks = {}
+
+
+def list_accounts(spec=TARGET_ACCOUNTS):
+    # "" runs in the own account only, "organization" lists the active accounts
+    # of the AWS Organization, anything else is a comma-separated account list
+    spec = spec.strip()
+    if not spec:
+        return [None]
+    if spec.lower() == 'organization':
+        # clients imports this module, so get_client is imported on use
+        from clients import get_client
+        paginator = get_client('organizations').get_paginator('list_accounts')
+        return sorted(account['Id'] for page in paginator.paginate()
+                      for account in page['Accounts'] if account['Status'] == 'ACTIVE')
+    return [account.strip() for account in spec.split(',') if account.strip()]
+
+
+def _sts_client():
+    from clients import get_client
+    return get_client('sts')
+
+
+def own_account_id():
+    if not _own_account:
+        _own_account.append(_sts_client().get_caller_identity()['Account'])
+    return _own_account[0]
+
+
+def _default_session():
+    # Also used by get_client for the own account, so it never looks up own_account_id
+    import boto3
+    with _lock:
+        if None not in _sessions:
+            _sessions[None] = (boto3.session.Session(), None)
+        return _sessions[None][0]
+
+
+def account_session(account_id, role_name=TARGET_ROLE_NAME):
+    """boto3 session for account_id, None or the own account use the default credentials."""
+    if account_id is None or account_id == own_account_id():
+        return _default_session()
+    import boto3
+    key = (account_id, role_name)
+    # One lock per account, so different accounts assume their roles in parallel
+    with _lock:
+        account_lock = _account_locks.setdefault(key, threading.Lock())
+    with account_lock:
+        session, expiration = _sessions.get(key, (None, None))
+        if session is None or expiration - datetime.now(timezone.utc) < REFRESH_MARGIN:
+            credentials = _sts_client().assume_role(
+                RoleArn='arn:aws:iam::{}:role/{}'.format(account_id, role_name),
+                RoleSessionName=os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'lambdas')[:64],
+            )['Credentials']
+            session = boto3.session.Session(
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+            )
+            expiration = credentials['Expiration']
+            _sessions[key] = (session, expiration)
+        return session
+
+
+def fan_out(work, accounts, role_name=TARGET_ROLE_NAME, max_workers=FAN_OUT_WORKERS):
+    # Runs work(account_id, session) for every account on a thread pool and returns
+    # {account_id: (result, None)} or {account_id: (None, exception)}
+    def run(account_id):
+        return work(account_id, account_session(account_id, role_name))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(accounts)))) as pool:
+        futures = {account_id: pool.submit(run, account_id) for account_id in accounts}
+        for account_id, future in futures.items():
+            try:
+                results[account_id] = (future.result(), None)
+            except Exception as e:
+                results[account_id] = (None, e)
+    return results
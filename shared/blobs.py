@@ -0,0 +1,96 @@
+import os
+import json
+
+
+class BlobStore:
+    """JSON documents and raw bodies by key, a missing key reads as None.
+
+    The empty key is the object or file the store was opened with, other keys
+    are below it. read returns (body, tag), the tag is passed back to skip the
+    download of an unchanged body.
+    """
+
+    def load(self, key=''):
+        body, _ = self.read(key)
+        return None if body is None else json.loads(body)
+
+    def save(self, key, value):
+        self.write(key, json.dumps(value, separators=(',', ':')).encode())
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key):
+        return os.path.join(self.path, key) if key else self.path
+
+    def read(self, key='', tag=None):
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None, None
+        if tag == mtime:
+            return None, tag
+        with open(path, 'rb') as blob_file:
+            return blob_file.read(), mtime
+
+    def write(self, key, body):
+        path = self._path(key)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wb') as blob_file:
+            blob_file.write(body)
+        os.replace(tmp_path, path)
+
+    def delete(self, key=''):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket, prefix, client=None):
+        # boto3 is only imported when an S3 store is configured, not on every cold start
+        from clients import get_client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = client or get_client('s3')
+
+    def _key(self, key):
+        return '/'.join(part for part in (self.prefix, key) if part)
+
+    def read(self, key='', tag=None):
+        # Without s3:ListBucket a missing object is reported as 403 instead of NoSuchKey
+        kwargs = {'IfNoneMatch': tag} if tag else {}
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key), **kwargs)
+        except self.client.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('NoSuchKey', '404'):
+                return None, None
+            if code == '304':
+                return None, tag
+            raise
+        return response['Body'].read(), response['ETag']
+
+    def write(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=body, ContentType='application/json')
+
+    def delete(self, key=''):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def open_blob_store(uri):
+    # s3://bucket/key-or-prefix, file://path or a local path, empty returns None
+    if not uri:
+        return None
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        return S3BlobStore(bucket, prefix)
+    if uri.startswith('file://'):
+        uri = uri[len('file://'):]
+    return LocalBlobStore(uri)
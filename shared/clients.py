@@ -0,0 +1,29 @@
+import threading
+
+from botocore.config import Config
+
+from accounts import TARGET_ROLE_NAME
+from accounts import account_session
+
+# Module level so warm invocations reuse the clients and their connection pools
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service, region_name=None, account_id=None, role_name=TARGET_ROLE_NAME, **config):
+    """boto3 client cached per (service, region, account, role) for the life of the container.
+
+    config holds botocore Config options and is part of the cache key. Clients of
+    an assumed role are rebuilt once accounts renews the role session.
+    """
+    key = (service, region_name, account_id, role_name if account_id else None, repr(sorted(config.items())))
+    session = account_session(account_id, role_name)
+    entry = _clients.get(key)
+    if entry is None or entry[0] is not session:
+        with _lock:
+            entry = _clients.get(key)
+            if entry is None or entry[0] is not session:
+                # Sessions are not thread safe, the clients they create are
+                client = session.client(service, region_name=region_name, config=Config(**config) if config else None)
+                entry = _clients[key] = (session, client)
+    return entry[1]
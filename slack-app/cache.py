@@ -0,0 +1,184 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from blobs import open_blob_store
+
+
+def _client(service):
+    from clients import get_client
+    return get_client(service)
+
+
+class BlobCacheBackend:
+    """Entries as JSON objects of a blob store, local files or S3 objects.
+
+    Neither has a conditional overwrite of expired entries, add reads then
+    writes, use DynamoDB for an atomic claim.
+    """
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def load(self, key):
+        return self.blobs.load(f"{key}.json")
+
+    def save(self, key, entry):
+        self.blobs.save(f"{key}.json", entry)
+
+    def add(self, key, entry, now):
+        existing = self.load(key)
+        if existing is not None and existing['expires'] > now:
+            return existing
+        self.save(key, entry)
+        return None
+
+    def discard(self, key):
+        self.blobs.delete(f"{key}.json")
+
+
+class DynamoCacheBackend:
+    """Entries as items of a table with the string partition key `key`.
+
+    `expires` is a number attribute, so it can be the table's TTL attribute.
+    """
+
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client or _client('dynamodb')
+
+    def load(self, key):
+        item = self.client.get_item(TableName=self.table, Key={'key': {'S': key}}).get('Item')
+        if item is None:
+            return None
+        return {'expires': float(item['expires']['N']), 'value': json.loads(item['value']['S'])}
+
+    def save(self, key, entry):
+        self.client.put_item(TableName=self.table, Item={
+            'key': {'S': key},
+            'expires': {'N': str(int(entry['expires']))},
+            'value': {'S': json.dumps(entry['value'])},
+        })
+
+    def add(self, key, entry, now):
+        # Written only when the key is missing or expired, TTL deletion lags behind
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={
+                    'key': {'S': key},
+                    'expires': {'N': str(int(entry['expires']))},
+                    'value': {'S': json.dumps(entry['value'])},
+                },
+                ConditionExpression='attribute_not_exists(#key) OR #expires <= :now',
+                ExpressionAttributeNames={'#key': 'key', '#expires': 'expires'},
+                ExpressionAttributeValues={':now': {'N': str(int(now))}},
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return self.load(key)
+        return None
+
+    def discard(self, key):
+        self.client.delete_item(TableName=self.table, Key={'key': {'S': key}})
+
+
+def open_cache_backend(uri):
+    # dynamodb://table, s3://bucket/prefix or a local directory, empty keeps the cache in memory only
+    if not uri:
+        return None
+    if uri.startswith('dynamodb://'):
+        return DynamoCacheBackend(uri[len('dynamodb://'):])
+    return BlobCacheBackend(open_blob_store(uri))
+
+
+class TTLCache:
+    """Bounded LRU of values that expire after ttl seconds.
+
+    Lives at module level, so warm invocations share it. Misses fall through
+    to the optional shared backend, so other Lambda instances share the hits.
+    A failing backend is reported and treated as a miss.
+    """
+
+    def __init__(self, max_entries, ttl, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _insert(self, key, expires, value):
+        # Callers hold the lock
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _remember(self, key, expires, value):
+        with self.lock:
+            self._insert(key, expires, value)
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                del self.entries[key]
+        if self.backend is None:
+            return None
+        try:
+            entry = self.backend.load(key)
+        except Exception as e:
+            print(f"Cache backend load failed for {key}: {e}")
+            return None
+        if entry is None or entry['expires'] <= now:
+            return None
+        self._remember(key, entry['expires'], entry['value'])
+        return entry['value']
+
+    def put(self, key, value, now=None):
+        expires = (time.time() if now is None else now) + self.ttl
+        self._remember(key, expires, value)
+        if self.backend is not None:
+            try:
+                self.backend.save(key, {'expires': expires, 'value': value})
+            except Exception as e:
+                print(f"Cache backend save failed for {key}: {e}")
+
+    def add(self, key, value, now=None):
+        """Stores value unless key holds an unexpired value, which is returned instead.
+
+        Returns None when this call stored the value. With a DynamoDB backend
+        only one Lambda instance can store a key.
+        """
+        now = time.time() if now is None else now
+        expires = now + self.ttl
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            if self.backend is None:
+                self._insert(key, expires, value)
+                return None
+        try:
+            existing = self.backend.add(key, {'expires': expires, 'value': value}, now)
+        except Exception as e:
+            print(f"Cache backend add failed for {key}: {e}")
+            existing = None
+        if existing is not None:
+            self._remember(key, existing['expires'], existing['value'])
+            return existing['value']
+        self._remember(key, expires, value)
+        return None
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        if self.backend is not None:
+            try:
+                self.backend.discard(key)
+            except Exception as e:
+                print(f"Cache backend discard failed for {key}: {e}")
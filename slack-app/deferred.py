@@ -0,0 +1,106 @@
+import os
+import json
+import urllib.parse
+
+from slack_sdk.webhook import WebhookClient
+
+# Key of the job in the event of an async self-invocation
+JOB_KEY = 'deferred_job'
+RESPONSE_URL_HOST = 'hooks.slack.com'
+
+
+class LambdaDispatcher:
+    """Runs jobs in an asynchronous invocation of this or another function."""
+
+    def __init__(self, function_name, client=None):
+        # boto3 is only imported when deferring is configured
+        from clients import get_client
+        self.function_name = function_name
+        self.client = client or get_client('lambda')
+
+    def send(self, job):
+        self.client.invoke(FunctionName=self.function_name, InvocationType='Event',
+                           Payload=json.dumps({JOB_KEY: job}).encode())
+
+
+class SqsDispatcher:
+    """Queues jobs on SQS, the function consumes the queue through an event source mapping."""
+
+    def __init__(self, queue_url, client=None):
+        from clients import get_client
+        self.queue_url = queue_url
+        self.client = client or get_client('sqs')
+
+    def send(self, job):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+
+
+class LocalDispatcher:
+    """Runs jobs on a thread of this process, a stand-in for local runs and tests.
+
+    Lambda freezes the process once the response is returned, do not use it deployed.
+    """
+
+    def __init__(self, run, pool):
+        self.run = run
+        self.pool = pool
+
+    def send(self, job):
+        self.pool.submit(self.run, job)
+
+
+def open_dispatcher(uri, run, pool):
+    # lambda (this function), lambda://function, an SQS queue URL or local, empty answers inline
+    if not uri:
+        return None
+    if uri == 'lambda':
+        return LambdaDispatcher(os.environ['AWS_LAMBDA_FUNCTION_NAME'])
+    if uri.startswith('lambda://'):
+        return LambdaDispatcher(uri[len('lambda://'):])
+    if uri.startswith('https://sqs.'):
+        return SqsDispatcher(uri)
+    if uri == 'local':
+        return LocalDispatcher(run, pool)
+    raise ValueError(f"Unsupported DEFER_URI {uri}")
+
+
+def is_deferred_event(event):
+    records = event.get('Records') or [{}]
+    return JOB_KEY in event or records[0].get('eventSource') == 'aws:sqs'
+
+
+def process_deferred_event(event, run):
+    """Runs the jobs of an async invocation or an SQS batch.
+
+    Failed SQS messages are reported as batch item failures, so only they are
+    retried (the event source mapping needs ReportBatchItemFailures).
+    """
+    if JOB_KEY in event:
+        run(event[JOB_KEY])
+        return {'processed': 1}
+    failures = []
+    for record in event['Records']:
+        try:
+            run(json.loads(record['body']))
+        except Exception as e:
+            print(f"Deferred job {record['messageId']} failed: {e}")
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def is_slack_response_url(url):
+    """Only Slack's own response URLs are posted to, any other host could receive user metadata"""
+    try:
+        parsed = urllib.parse.urlsplit(url or '')
+        port = parsed.port
+    except ValueError:
+        return False
+    return (parsed.scheme == 'https' and parsed.hostname == RESPONSE_URL_HOST and port in (None, 443)
+            and not parsed.username and parsed.path.startswith('/'))
+
+
+def post_response(response_url, message):
+    """Posts the final message to the response_url of the Slack payload"""
+    response = WebhookClient(response_url).send_dict(message)
+    if response.status_code != 200:
+        raise RuntimeError(f"response_url returned {response.status_code}: {response.body}")
@@ -81,8 +81,8 @@ echo "📂 Using site-packages: $PYTHON_SITE_PACKAGES"
 
 # Create deployment package
 echo "📦 Creating deployment package..."
-# First, create zip with main.py
-zip deployment-package.zip main.py
+# First, create zip with main.py and its modules
+zip deployment-package.zip *.py -x 'test_*.py'
 
 # Then add all dependencies from site-packages
 cd $PYTHON_SITE_PACKAGES
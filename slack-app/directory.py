@@ -0,0 +1,175 @@
+import json
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from blobs import open_blob_store
+
+SNAPSHOT_VERSION = 1
+PAGE_SIZE = 200
+MAX_RATE_LIMIT_RETRIES = 5
+# Snapshot users are stored as value lists in this order instead of dicts
+FIELDS = [
+    "user_id", "username", "real_name", "display_name", "email", "phone", "title", "team",
+    "timezone", "timezone_label", "timezone_offset", "is_admin", "is_owner", "is_bot",
+    "status", "status_emoji", "avatar", "last_seen", "deleted",
+]
+
+
+def compile_metadata(user, profile):
+    """Compile the metadata shown to the user from a Slack user and profile"""
+    return {
+        "user_id": user.get('id'),
+        "username": user.get('name'),
+        "real_name": user.get('real_name'),
+        "display_name": profile.get('display_name'),
+        "email": profile.get('email'),
+        "phone": profile.get('phone'),
+        "title": profile.get('title'),
+        "team": user.get('team_id'),
+        "timezone": user.get('tz'),
+        "timezone_label": user.get('tz_label'),
+        "timezone_offset": user.get('tz_offset'),
+        "is_admin": user.get('is_admin', False),
+        "is_owner": user.get('is_owner', False),
+        "is_bot": user.get('is_bot', False),
+        "status": profile.get('status_text'),
+        "status_emoji": profile.get('status_emoji'),
+        "avatar": profile.get('image_512'),
+        "last_seen": user.get('updated'),
+        "deleted": user.get('deleted', False)
+    }
+
+
+def list_users(slack_client, page_size=PAGE_SIZE):
+    """Yields every user of the workspace, sleeping out Slack's Retry-After on rate limits"""
+    cursor = None
+    retries = 0
+    while True:
+        try:
+            response = slack_client.users_list(limit=page_size, cursor=cursor)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or retries >= MAX_RATE_LIMIT_RETRIES:
+                raise
+            headers = {name.lower(): value for name, value in e.response.headers.items()}
+            delay = int(headers.get('retry-after', 1))
+            retries += 1
+            print(f"users.list rate limited, retrying in {delay}s")
+            time.sleep(delay)
+            continue
+        retries = 0
+        yield from response.get('members', [])
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+class DirectorySnapshot:
+    """Compiled metadata of every workspace user, indexed by user id."""
+
+    def __init__(self, users=None, created=0):
+        self.users = users or {}
+        self.created = created
+
+    @classmethod
+    def fetch(cls, slack_client, now=None):
+        users = {}
+        for user in list_users(slack_client):
+            metadata = compile_metadata(user, user.get('profile', {}))
+            users[user['id']] = [metadata[field] for field in FIELDS]
+        return cls(users, time.time() if now is None else now)
+
+    def get(self, user_id):
+        values = self.users.get(user_id)
+        return dict(zip(FIELDS, values)) if values is not None else None
+
+    def to_json(self):
+        return json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'created': self.created,
+            'fields': FIELDS,
+            'users': self.users,
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, body):
+        data = json.loads(body)
+        if data.get('version') != SNAPSHOT_VERSION or data.get('fields') != FIELDS:
+            return None
+        return cls(data['users'], data['created'])
+
+
+class SnapshotStore:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def load(self, tag=None):
+        # Returns (snapshot, tag), snapshot is None when unchanged since tag or missing
+        body, tag = self.blobs.read('', tag)
+        return (DirectorySnapshot.from_json(body) if body is not None else None), tag
+
+    def save(self, snapshot):
+        self.blobs.write('', snapshot.to_json().encode())
+
+
+def open_snapshot_store(uri):
+    # Empty disables the directory snapshot
+    blobs = open_blob_store(uri)
+    return SnapshotStore(blobs) if blobs else None
+
+
+class Directory:
+    """The latest snapshot of a store, checked again every reload seconds.
+
+    Entries are only served while the snapshot is younger than max_age.
+    """
+
+    def __init__(self, store, max_age, reload):
+        self.store = store
+        self.max_age = max_age
+        self.reload = reload
+        self.snapshot = None
+        self.tag = None
+        self.checked = 0
+
+    def get(self, user_id, now=None):
+        now = time.time() if now is None else now
+        if now - self.checked >= self.reload:
+            self.checked = now
+            try:
+                snapshot, self.tag = self.store.load(self.tag)
+            except Exception as e:
+                print(f"Loading the directory snapshot failed: {e}")
+                snapshot = None
+            if snapshot is not None:
+                self.snapshot = snapshot
+        if self.snapshot is None or now - self.snapshot.created > self.max_age:
+            return None
+        return self.snapshot.get(user_id)
+
+
+class UserGroupIndex:
+    """Members of Slack user groups as one frozenset, fetched again after ttl seconds.
+
+    A failed refresh keeps serving the previous members.
+    """
+
+    def __init__(self, slack_client, group_ids, ttl):
+        self.slack_client = slack_client
+        self.group_ids = group_ids
+        self.ttl = ttl
+        self.members = frozenset()
+        self.expires = 0
+
+    def __contains__(self, user_id):
+        now = time.time()
+        if now >= self.expires:
+            self.expires = now + self.ttl
+            try:
+                members = set()
+                for group_id in self.group_ids:
+                    members.update(self.slack_client.usergroups_users_list(usergroup=group_id).get('users', []))
+                self.members = frozenset(members)
+            except Exception as e:
+                print(f"Refreshing the user group members failed: {e}")
+        return user_id in self.members
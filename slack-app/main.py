@@ -1,20 +1,75 @@
 import json
 import os
 import hmac
+import random
 import hashlib
 import urllib.parse
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
+from cache import TTLCache, open_cache_backend
+from directory import Directory, DirectorySnapshot, UserGroupIndex, compile_metadata, open_snapshot_store
+from deferred import open_dispatcher, is_deferred_event, is_slack_response_url, process_deferred_event, post_response
+
 # Environment variables (set these in Lambda configuration)
 SLACK_BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
 SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
 ALLOWED_USER_IDS = os.environ.get('ALLOWED_USER_IDS', 'ANY')  # Comma-separated user IDs or 'ANY'
+ALLOWED_USER_GROUPS = os.environ.get('ALLOWED_USER_GROUPS', '')  # Comma-separated Slack user group IDs
+USER_GROUP_TTL = int(os.environ.get('USER_GROUP_TTL', '300'))  # Seconds user group members are reused
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()  # DEBUG logs every request
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '0'))  # Share of requests logged at INFO
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '300'))  # Seconds compiled metadata is reused
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '1000'))
+USER_CACHE_URI = os.environ.get('USER_CACHE_URI', '')  # dynamodb://table, s3://bucket/prefix or a directory
+DEFER_URI = os.environ.get('DEFER_URI', '')  # lambda, lambda://function, an SQS queue URL or local
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '300'))  # Seconds a response is replayed to retries
+IDEMPOTENCY_URI = os.environ.get('IDEMPOTENCY_URI', '')  # dynamodb://table, s3://bucket/prefix or a directory
+DIRECTORY_URI = os.environ.get('DIRECTORY_URI', '')  # s3://bucket/key or a file of the users.list snapshot
+DIRECTORY_MAX_AGE = int(os.environ.get('DIRECTORY_MAX_AGE', '7200'))  # Seconds a snapshot is served
+DIRECTORY_RELOAD = int(os.environ.get('DIRECTORY_RELOAD', '300'))  # Seconds between checks for a newer snapshot
+
+# Parsed once, not on every request
+ALLOWED_GROUP_IDS = [gid.strip() for gid in ALLOWED_USER_GROUPS.split(',') if gid.strip()]
+# 'ANY' allows every user, ALLOWED_USER_GROUPS only adds members to a list of user IDs
+ALLOW_ANY_USER = ALLOWED_USER_IDS.strip() == 'ANY'
+ALLOWED_USERS = frozenset() if ALLOW_ANY_USER else frozenset(
+    uid.strip() for uid in ALLOWED_USER_IDS.split(',') if uid.strip())
+DEBUG_LOGGING = LOG_LEVEL == 'DEBUG'
+
+# Claim of a delivery still being processed
+IN_PROGRESS = 'in-progress'
+
+# Actions calling the Slack API, answered through the response_url when deferring
+DEFERRED_ACTIONS = {"get_user_metadata"}
 
 # Initialize Slack client
 slack_client = WebClient(token=SLACK_BOT_TOKEN) if SLACK_BOT_TOKEN else None
 
+# Module level so warm invocations reuse the cached metadata and the threads
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, open_cache_backend(USER_CACHE_URI))
+slack_pool = ThreadPoolExecutor(max_workers=4)
+idempotency_cache = TTLCache(1000, IDEMPOTENCY_TTL, open_cache_backend(IDEMPOTENCY_URI))
+snapshot_store = open_snapshot_store(DIRECTORY_URI)
+directory = Directory(snapshot_store, DIRECTORY_MAX_AGE, DIRECTORY_RELOAD) if snapshot_store else None
+allowed_groups = UserGroupIndex(slack_client, ALLOWED_GROUP_IDS, USER_GROUP_TTL) if ALLOWED_GROUP_IDS and slack_client else ()
+if ALLOWED_GROUP_IDS and ALLOW_ANY_USER:
+    print("WARNING: ALLOWED_USER_GROUPS is ignored, ALLOWED_USER_IDS=ANY allows every user")
+elif ALLOWED_GROUP_IDS and not slack_client:
+    print("WARNING: ALLOWED_USER_GROUPS cannot be resolved without SLACK_BOT_TOKEN, only ALLOWED_USER_IDS are allowed")
+
+class StaticResponse(dict):
+    """Response that never changes, serialized once at import"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.body = json.dumps(self)
+
+def response_body(response):
+    """JSON body of a response, static responses are not serialized again"""
+    return response.body if isinstance(response, StaticResponse) else json.dumps(response)
+
 def verify_slack_request(headers, body):
     """Verify that the request comes from Slack"""
     if not SLACK_SIGNING_SECRET:
@@ -39,56 +94,51 @@ def verify_slack_request(headers, body):
 
 def is_user_allowed(user_id):
     """Check if user is allowed to use this function"""
-    if ALLOWED_USER_IDS == 'ANY':
+    if ALLOW_ANY_USER:
         return True
 
-    allowed_users = [uid.strip() for uid in ALLOWED_USER_IDS.split(',')]
-    return user_id in allowed_users
+    return user_id in ALLOWED_USERS or user_id in allowed_groups
+
+def fetch_user_metadata(user_id):
+    """Fetch user info and profile concurrently, a miss costs one round-trip"""
+    profile_future = slack_pool.submit(slack_client.users_profile_get, user=user_id)
+    user_info = slack_client.users_info(user=user_id)
+    profile_info = profile_future.result()
+    return compile_metadata(user_info.get('user', {}), profile_info.get('profile', {}))
+
+def cached_user_metadata(user_id):
+    """Metadata of the user cache or the prewarmed snapshot, None when Slack has to be asked"""
+    # Repeat clicks within USER_CACHE_TTL never reach the Slack API
+    metadata = user_cache.get(user_id)
+    if metadata is not None:
+        return metadata
+
+    # Users missing from the snapshot or a stale snapshot fall back to the Slack API
+    metadata = directory.get(user_id) if directory else None
+    if metadata is not None:
+        user_cache.put(user_id, metadata)
+    return metadata
 
 def get_user_metadata(user_id):
     """Get comprehensive user metadata from Slack"""
     if not slack_client:
         return {"error": "Slack client not initialized"}
 
-    try:
-        # Get user info
-        user_info = slack_client.users_info(user=user_id)
-        user = user_info.get('user', {})
-
-        # Get user profile
-        profile_info = slack_client.users_profile_get(user=user_id)
-        profile = profile_info.get('profile', {})
-
-        # Compile metadata
-        metadata = {
-            "user_id": user.get('id'),
-            "username": user.get('name'),
-            "real_name": user.get('real_name'),
-            "display_name": profile.get('display_name'),
-            "email": profile.get('email'),
-            "phone": profile.get('phone'),
-            "title": profile.get('title'),
-            "team": user.get('team_id'),
-            "timezone": user.get('tz'),
-            "timezone_label": user.get('tz_label'),
-            "timezone_offset": user.get('tz_offset'),
-            "is_admin": user.get('is_admin', False),
-            "is_owner": user.get('is_owner', False),
-            "is_bot": user.get('is_bot', False),
-            "status": profile.get('status_text'),
-            "status_emoji": profile.get('status_emoji'),
-            "avatar": profile.get('image_512'),
-            "last_seen": user.get('updated'),
-            "deleted": user.get('deleted', False)
-        }
-
+    metadata = cached_user_metadata(user_id)
+    if metadata is not None:
         return metadata
 
+    try:
+        metadata = fetch_user_metadata(user_id)
     except SlackApiError as e:
         return {"error": f"Slack API error: {e.response['error']}"}
     except Exception as e:
         return {"error": f"Unexpected error: {str(e)}"}
 
+    # Errors are not cached, the next click tries again
+    user_cache.put(user_id, metadata)
+    return metadata
+
 def create_menu_blocks():
     """Create interactive menu blocks"""
     return [
@@ -175,22 +225,42 @@ def format_metadata_response(metadata):
 
     return response
 
+# Static responses, built and serialized once at import
+MENU_RESPONSE = StaticResponse(response_type="ephemeral", blocks=create_menu_blocks())
+COMMAND_DENIED_RESPONSE = StaticResponse(
+    response_type="ephemeral",
+    text="🚫 Access denied. You are not authorized to use this command."
+)
+ACTION_DENIED_RESPONSE = StaticResponse(text="🚫 Access denied. You are not authorized to use this function.")
+WORKING_RESPONSE = StaticResponse(text="⏳ Working on it…", response_type="ephemeral")
+STILL_WORKING_RESPONSE = StaticResponse(response_type="ephemeral", text="⏳ Still working on it…")
+ABOUT_RESPONSE = StaticResponse(
+    text="ℹ️ *Slack User Information Tool*\n\n"
+         "This secure lambda function provides:\n"
+         "• 📊 Comprehensive user metadata from Slack\n"
+         "• 🔒 User access restrictions\n"
+         "• ✅ Request signature validation\n"
+         "• 🛡️ Security-first design\n\n"
+         f"🔧 Environment: `{os.environ.get('AWS_REGION', 'Unknown')}`\n"
+         f"🎯 Function: `{os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'Unknown')}`",
+    response_type="ephemeral"
+)
+UNKNOWN_ACTION_RESPONSE = StaticResponse(text="🤔 Unknown action. Please try again.", response_type="ephemeral")
+UNPROCESSED_RESPONSE = StaticResponse(
+    response_type="ephemeral",
+    text="🤔 I received your request but couldn't process it. Check the logs for details."
+)
+
 def handle_slash_command(event):
     """Handle slash command"""
     user_id = event.get('user_id')
 
     # Check if user is allowed
     if not is_user_allowed(user_id):
-        return {
-            "response_type": "ephemeral",
-            "text": "🚫 Access denied. You are not authorized to use this command."
-        }
+        return COMMAND_DENIED_RESPONSE
 
     # Return interactive menu
-    return {
-        "response_type": "ephemeral",
-        "blocks": create_menu_blocks()
-    }
+    return MENU_RESPONSE
 
 def handle_interactive_action(payload):
     """Handle interactive button clicks"""
@@ -200,10 +270,26 @@ def handle_interactive_action(payload):
 
     # Check if user is allowed
     if not is_user_allowed(user_id):
-        return {
-            "text": "🚫 Access denied. You are not authorized to use this function."
-        }
-
+        return ACTION_DENIED_RESPONSE
+
+    # Slack gives up after 3 seconds, so slow work is acknowledged at once and
+    # finished by a deferred job, cached metadata is still answered inline
+    dispatcher = get_dispatcher()
+    if (dispatcher and action_id in DEFERRED_ACTIONS and payload.get('response_url')
+            and cached_user_metadata(user_id) is None):
+        if not is_slack_response_url(payload['response_url']):
+            print(f"Not deferring {action_id}, response_url is not a Slack URL: {payload['response_url']}")
+            return ACTION_DENIED_RESPONSE
+        try:
+            dispatcher.send({"payload": payload})
+            return WORKING_RESPONSE
+        except Exception as e:
+            print(f"Deferring {action_id} failed, answering inline: {e}")
+
+    return action_response(user_id, action_id)
+
+def action_response(user_id, action_id):
+    """Build the response of an allowed action"""
     if action_id == "get_user_metadata":
         metadata = get_user_metadata(user_id)
         response_text = format_metadata_response(metadata)
@@ -214,46 +300,112 @@ def handle_interactive_action(payload):
         }
 
     elif action_id == "check_user_access":
-        allowed = is_user_allowed(user_id)
-        access_status = "✅ Allowed" if allowed else "🚫 Denied"
-
+        # Only allowed users get here, handle_interactive_action already checked
         return {
-            "text": f"🔒 *Access Status:* {access_status}\n\n"
+            "text": "🔒 *Access Status:* ✅ Allowed\n\n"
                    f"User ID: `{user_id}`\n"
                    f"Allowed Users: `{ALLOWED_USER_IDS}`",
             "response_type": "ephemeral"
         }
 
     elif action_id == "show_about":
-        return {
-            "text": "ℹ️ *Slack User Information Tool*\n\n"
-                   "This secure lambda function provides:\n"
-                   "• 📊 Comprehensive user metadata from Slack\n"
-                   "• 🔒 User access restrictions\n"
-                   "• ✅ Request signature validation\n"
-                   "• 🛡️ Security-first design\n\n"
-                   f"🔧 Environment: `{os.environ.get('AWS_REGION', 'Unknown')}`\n"
-                   f"🎯 Function: `{os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'Unknown')}`",
-            "response_type": "ephemeral"
-        }
+        return ABOUT_RESPONSE
 
     # Default response
-    return {
-        "text": "🤔 Unknown action. Please try again.",
-        "response_type": "ephemeral"
-    }
+    return UNKNOWN_ACTION_RESPONSE
+
+def idempotency_key(headers, trigger_id):
+    """Key of a Slack delivery, the same for all its retries"""
+    if trigger_id:
+        source = trigger_id
+    elif headers.get('x-slack-signature'):
+        source = f"{headers.get('x-slack-request-timestamp', '')}:{headers['x-slack-signature']}"
+    else:
+        return None
+    return 'request-' + hashlib.sha256(source.encode()).hexdigest()
+
+def respond_once(key, headers, handle):
+    """Run handle once per delivery, retries and duplicates get the stored response body"""
+    if key is None:
+        return response_body(handle())
+
+    previous = idempotency_cache.add(key, IN_PROGRESS)
+    if previous is not None:
+        print(f"Duplicate delivery {key} (retry {headers.get('x-slack-retry-num', 0)})")
+        if previous == IN_PROGRESS:
+            return STILL_WORKING_RESPONSE.body
+        return previous
+
+    try:
+        body = response_body(handle())
+    except Exception:
+        # Released, so a retry can try again
+        idempotency_cache.discard(key)
+        raise
+    idempotency_cache.put(key, body)
+    return body
+
+def run_deferred_job(job):
+    """Finish a deferred action and post the result to its response_url"""
+    payload = job['payload']
+    if not is_slack_response_url(payload.get('response_url')):
+        print(f"Dropping deferred job, response_url is not a Slack URL: {payload.get('response_url')}")
+        return
+    # SQS and async invocations deliver at least once, a job is posted only once
+    key = idempotency_key({}, payload.get('trigger_id'))
+    if key and idempotency_cache.add(f"{key}-job", IN_PROGRESS) is not None:
+        print(f"Duplicate deferred job {key}")
+        return
+    try:
+        response = dict(action_response(payload['user']['id'], payload['actions'][0]['action_id']),
+                        replace_original=True)
+        post_response(payload['response_url'], response)
+    except Exception:
+        if key:
+            idempotency_cache.discard(f"{key}-job")
+        raise
+
+_dispatcher = []
+
+def get_dispatcher():
+    """Dispatcher of DEFER_URI, created on first use and reused by warm invocations"""
+    if not _dispatcher:
+        _dispatcher.append(open_dispatcher(DEFER_URI, run_deferred_job, slack_pool))
+    return _dispatcher[0]
+
+def prewarm_directory():
+    """Store a snapshot of every workspace user, run on a schedule"""
+    if not slack_client or not snapshot_store:
+        return {"error": "SLACK_BOT_TOKEN and DIRECTORY_URI are required to prewarm the directory"}
+    snapshot = DirectorySnapshot.fetch(slack_client)
+    snapshot_store.save(snapshot)
+    print(f"Directory snapshot of {len(snapshot.users)} users stored")
+    return {"users": len(snapshot.users)}
 
 def lambda_handler(event, context):
     """Main Lambda handler with Function URL support"""
+    # Deferred jobs from an async self-invocation or the SQS queue
+    if is_deferred_event(event):
+        return process_deferred_event(event, run_deferred_job)
+
+    # EventBridge schedule of the directory prewarm
+    if event.get('detail-type') == 'Scheduled Event' or event.get('action') == 'prewarm_directory':
+        return prewarm_directory()
+
+    # Dumps of the request are costly, only every request at DEBUG or a sample of them
+    debug = DEBUG_LOGGING or (DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE)
+
     try:
-        print(f"Event: {json.dumps(event)}")  # Debug logging
+        if debug:
+            print(f"Event: {json.dumps(event)}")
 
         # Handle Function URL requests
         if 'rawPath' in event and 'requestContext' in event:
             headers = event.get('headers', {})
             body = event.get('body', '')
-            print(f"Headers: {json.dumps(headers)}")  # Debug logging
-            print(f"Body: {body}")  # Debug logging
+            if debug:
+                print(f"Headers: {json.dumps(headers)}")
+                print(f"Body: {body}")
 
             # For debugging, temporarily skip signature verification
             # TODO: Re-enable after debugging
@@ -266,37 +418,49 @@ def lambda_handler(event, context):
             # Parse form data
             if body:
                 content_type = headers.get('content-type', '').lower()
-                print(f"Content-Type: {content_type}")  # Debug logging
+                if debug:
+                    print(f"Content-Type: {content_type}")
 
                 if content_type.startswith('application/x-www-form-urlencoded'):
                     parsed_body = urllib.parse.parse_qs(body)
-                    print(f"Parsed body: {json.dumps(parsed_body)}")  # Debug logging
+                    if debug:
+                        print(f"Parsed body: {json.dumps(parsed_body)}")
 
                     # Handle slash command
                     if 'command' in parsed_body:
-                        print("Handling slash command")  # Debug logging
-                        response = handle_slash_command({
-                            'user_id': parsed_body.get('user_id', [''])[0],
-                            'command': parsed_body.get('command', [''])[0],
-                            'text': parsed_body.get('text', [''])[0]
-                        })
-                        print(f"Slash command response: {json.dumps(response)}")  # Debug logging
+                        if debug:
+                            print("Handling slash command")
+                        body_json = respond_once(
+                            idempotency_key(headers, parsed_body.get('trigger_id', [''])[0]),
+                            headers,
+                            lambda: handle_slash_command({
+                                'user_id': parsed_body.get('user_id', [''])[0],
+                                'command': parsed_body.get('command', [''])[0],
+                                'text': parsed_body.get('text', [''])[0]
+                            })
+                        )
+                        if debug:
+                            print(f"Slash command response: {body_json}")
 
                         return {
                             'statusCode': 200,
                             'headers': {'Content-Type': 'application/json'},
-                            'body': json.dumps(response)
+                            'body': body_json
                         }
 
                     # Handle interactive components
                     elif 'payload' in parsed_body:
                         payload = json.loads(parsed_body['payload'][0])
-                        response = handle_interactive_action(payload)
+                        body_json = respond_once(
+                            idempotency_key(headers, payload.get('trigger_id')),
+                            headers,
+                            lambda: handle_interactive_action(payload)
+                        )
 
                         return {
                             'statusCode': 200,
                             'headers': {'Content-Type': 'application/json'},
-                            'body': json.dumps(response)
+                            'body': body_json
                         }
 
             # Default response for Function URL - this means we got a request but couldn't process it
@@ -304,10 +468,7 @@ def lambda_handler(event, context):
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({
-                    'response_type': 'ephemeral',
-                    'text': '🤔 I received your request but couldn\'t process it. Check the logs for details.'
-                })
+                'body': UNPROCESSED_RESPONSE.body
             }
 
         # Handle direct Lambda invocation (for testing)
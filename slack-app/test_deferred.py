@@ -0,0 +1,38 @@
+"""Checks which response URLs deferred jobs may post to.
+
+Runs without AWS or Slack access: python3 test_deferred.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from deferred import is_slack_response_url
+
+
+def test_slack_response_urls_are_accepted():
+    assert is_slack_response_url('https://hooks.slack.com/actions/T0001/123456/abcdef')
+    assert is_slack_response_url('https://hooks.slack.com:443/commands/T0001/123456/abcdef')
+
+
+def test_other_hosts_and_schemes_are_rejected():
+    for url in [
+        None,
+        '',
+        'http://hooks.slack.com/actions/T0001/123456/abcdef',
+        'https://hooks.slack.com.example.com/actions/T0001',
+        'https://example.com/actions/T0001?host=hooks.slack.com',
+        'https://hooks.slack.com@example.com/actions/T0001',
+        'https://user@hooks.slack.com/actions/T0001',
+        'https://hooks.slack.com:8443/actions/T0001',
+        'https://hooks.slack.com:bad/actions/T0001',
+        'https://169.254.169.254/latest/meta-data/',
+    ]:
+        assert not is_slack_response_url(url), url
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('ok', name)
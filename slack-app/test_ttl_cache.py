@@ -0,0 +1,59 @@
+"""Checks expiry, eviction and the shared backend of the TTL cache.
+
+Runs without AWS or Slack access: python3 test_ttl_cache.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache import TTLCache
+from cache import open_cache_backend
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(max_entries=10, ttl=60)
+    cache.put('U1', {'name': 'one'}, now=1000)
+    assert cache.get('U1', now=1059) == {'name': 'one'}
+    assert cache.get('U1', now=1060) is None
+    assert 'U1' not in cache.entries
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(max_entries=2, ttl=60)
+    cache.put('U1', 1, now=1000)
+    cache.put('U2', 2, now=1000)
+    assert cache.get('U1', now=1001) == 1
+    cache.put('U3', 3, now=1002)
+    assert list(cache.entries) == ['U1', 'U3']
+    assert cache.get('U2', now=1003) is None
+
+
+def test_add_only_stores_missing_or_expired_keys():
+    cache = TTLCache(max_entries=10, ttl=60)
+    assert cache.add('event', 'first', now=1000) is None
+    assert cache.add('event', 'second', now=1030) == 'first'
+    assert cache.add('event', 'third', now=1060) is None
+    cache.discard('event')
+    assert cache.get('event', now=1061) is None
+
+
+def test_misses_fall_through_to_the_backend():
+    directory = tempfile.mkdtemp()
+    writer = TTLCache(max_entries=10, ttl=60, backend=open_cache_backend(directory))
+    writer.put('U1', {'name': 'one'}, now=1000)
+    reader = TTLCache(max_entries=10, ttl=60, backend=open_cache_backend('file://' + directory))
+    assert reader.get('U1', now=1010) == {'name': 'one'}
+    assert reader.get('U1', now=1060) is None
+    assert reader.add('U1', 'other', now=1010) == {'name': 'one'}
+    reader.discard('U1')
+    assert os.listdir(directory) == []
+    assert reader.get('U2', now=1010) is None
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print('ok', name)
@@ -2,7 +2,7 @@
 
 echo "Select a Lambda:"
 # List directories, but put README.md last
-DIRS=$(ls -d * | grep -v "start.sh\|Makefile\|create-or-update-function.sh\|README.md")
+DIRS=$(ls -d * | grep -v "start.sh\|Makefile\|create-or-update-function.sh\|publish-layers.sh\|README.md\|shared\|package.py\|build")
 if [ -f "README.md" ]; then
     DIRS="$DIRS README.md"
 fi